@@ -0,0 +1,666 @@
+"""
+Benchmarks for the DDI import pipeline
+
+Use the paster command to run them:
+
+    paster --plugin=ckanext-ddi ddi benchmark <path> [<rounds>]
+    paster --plugin=ckanext-ddi ddi benchmark-fetch [<studies>] [<concurrency>]
+    paster --plugin=ckanext-ddi ddi benchmark-gather [<studies>] [<page_size>]
+        [<concurrency>]
+    paster --plugin=ckanext-ddi ddi benchmark-suite [<variables>] [<keywords>]
+        [<nations>] [<coll_dates>] [<rounds>]
+    paster --plugin=ckanext-ddi ddi benchmark-variables [<variables>]
+        [<rounds>]
+    paster --plugin=ckanext-ddi ddi benchmark-schema [<dataset>] [<rounds>]
+    paster --plugin=ckanext-ddi ddi benchmark-render [<sections>] [<fields>]
+        [<rounds>]
+
+The suite runs offline on synthetic DDI codebooks, all database access
+and CKAN actions of the import stage are stubbed.
+"""
+import json
+import os
+import resource
+import tempfile
+import threading
+import urlparse
+import zlib
+from collections import OrderedDict
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from io import BytesIO
+from multiprocessing import Pipe, Process
+from time import sleep
+from timeit import default_timer as timer
+
+import jinja2
+import requests
+from lxml import etree
+
+import ckan.plugins.toolkit as tk
+from ckan.lib.plugins import lookup_package_plugin
+
+from ckanext.ddi import httpclient, plugins
+from ckanext.ddi.harvesters import NadaHarvester
+from ckanext.ddi.importer import metadata, DdiImporter
+from ckanext.ddi.importer.variables import (
+    VariableStore, extract_variables, iter_variables
+)
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def iter_xpath_values(value):
+    """ Yield all XPathValue instances of a (nested) mapping value """
+    if isinstance(value, metadata.XPathValue):
+        yield value
+    elif isinstance(value, metadata.Value):
+        for xpath_value in iter_xpath_values(value._config):
+            yield xpath_value
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            for xpath_value in iter_xpath_values(item):
+                yield xpath_value
+
+
+def get_mapping_xpath_values(ckan_metadata):
+    xpath_values = []
+    for key in ckan_metadata.metadata:
+        xpath_values.extend(
+            iter_xpath_values(ckan_metadata.get_attribute(key))
+        )
+    return xpath_values
+
+
+def _time_rounds(func, rounds):
+    start = timer()
+    for i in xrange(rounds):
+        func()
+    return (timer() - start) / rounds
+
+
+def benchmark_xpath(xml_string, rounds=10):
+    """
+    Compare the per-document cost of evaluating all XPath expressions of
+    the DDI mapping as strings on the document root (as done before the
+    expressions were precompiled) with the precompiled, anchored
+    expressions. The time to load a document with a full parse (load) is
+    compared to the incremental parse of load_file. All times are in
+    seconds per document.
+    """
+    ckan_metadata = metadata.DdiCkanMetadata()
+    xpath_values = get_mapping_xpath_values(ckan_metadata)
+
+    dataset_xml = etree.fromstring(xml_string)
+    context_xml = ckan_metadata.get_context_element(dataset_xml)
+
+    def uncompiled():
+        for value in xpath_values:
+            dataset_xml.xpath(value._config, namespaces=metadata.namespaces)
+
+    def compiled():
+        for value in xpath_values:
+            value._xpath(context_xml)
+
+    return {
+        'expressions': len(xpath_values),
+        'uncompiled_xpath': _time_rounds(uncompiled, rounds),
+        'compiled_xpath': _time_rounds(compiled, rounds),
+        'load': _time_rounds(lambda: ckan_metadata.load(xml_string), rounds),
+        'load_file': _time_rounds(
+            lambda: ckan_metadata.load_file(BytesIO(xml_string)),
+            rounds
+        ),
+    }
+
+
+def _max_rss():
+    """ Peak resident set size of this process in KB (on Linux) """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _measure(func):
+    """
+    Run func once in a forked process and return a tuple (seconds, KB),
+    the KB being the increase of the peak RSS caused by func. Running it
+    in a new process keeps the result independent of earlier peaks.
+    """
+    receiver, sender = Pipe(duplex=False)
+
+    def run():
+        start_rss = _max_rss()
+        start = timer()
+        func()
+        sender.send((timer() - start, _max_rss() - start_rss))
+
+    process = Process(target=run)
+    process.start()
+    result = receiver.recv()
+    process.join()
+    return result
+
+
+def generate_ddi(variables=1000, keywords=10, nations=3, coll_dates=2,
+                 study_id='SYN-1'):
+    """
+    Returns a synthetic DDI codebook (UTF-8 encoded) with all mapped study
+    fields, the given number of keywords, nations and collection date
+    ranges, and `variables` variables in dataDscr, each with a label, two
+    categories and summary statistics.
+    """
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<codeBook xmlns="http://www.icpsr.umich.edu/DDI" version="1.2.2">\n'
+        '<docDscr><citation><titlStmt><titl>Study %(id)s</titl>'
+        '</titlStmt></citation></docDscr>\n'
+        '<stdyDscr><citation>'
+        '<titlStmt><titl>Study %(id)s</titl><altTitl>S%(id)s</altTitl>'
+        '<IDNo>%(id)s</IDNo></titlStmt>'
+        '<rspStmt><AuthEnty>National Statistics Office</AuthEnty>'
+        '<othId>Ministry of Health</othId></rspStmt>'
+        '<prodStmt><fundAg>World Bank</fundAg></prodStmt>'
+        '<distStmt><contact email="data@example.org">Data Office</contact>'
+        '</distStmt>'
+        '<serStmt><serName>Other Household Survey [hh/oth]</serName>'
+        '<serInfo>Series %(id)s</serInfo></serStmt>'
+        '<verStmt><version date="2015-01-01">v01</version>'
+        '<notes>Version notes</notes></verStmt>'
+        '</citation>\n<stdyInfo><subject>' % {'id': study_id}
+    ]
+    parts.extend(
+        '<keyword>keyword %s</keyword>' % i for i in range(keywords)
+    )
+    parts.append(
+        '</subject><abstract>%s</abstract><sumDscr>'
+        % ('Synthetic abstract. ' * 50)
+    )
+    parts.extend(
+        '<collDate event="start" date="%s-01" cycle="Round %s"/>'
+        '<collDate event="end" date="%s-06" cycle="Round %s"/>'
+        % (2000 + i, i, 2000 + i, i)
+        for i in range(coll_dates)
+    )
+    parts.extend('<nation>Nation %s</nation>' % i for i in range(nations))
+    parts.append(
+        '<geogCover>National</geogCover><anlyUnit>Households</anlyUnit>'
+        '<universe>All households</universe>'
+        '<dataKind>Sample survey data [ssd]</dataKind></sumDscr>'
+        '<notes>Study notes</notes></stdyInfo>\n'
+        '<method><dataColl><sampProc>%s</sampProc>'
+        '<collMode>Face-to-face [f2f]</collMode></dataColl></method>\n'
+        '<dataAccs><setAvail>'
+        '<accsPlac URI="http://example.org/study/%s">Example</accsPlac>'
+        '</setAvail><useStmt><contact>Data Office</contact>'
+        '<conditions>Public use</conditions><citReq>Cite it</citReq>'
+        '</useStmt></dataAccs>\n'
+        '</stdyDscr>\n<dataDscr>\n'
+        % ('Synthetic sampling procedure. ' * 50, study_id)
+    )
+    parts.extend(
+        '<var ID="V%(i)s" name="v%(i)s" files="F1">'
+        '<labl>Label of variable %(i)s</labl>'
+        '<sumStat type="vald">1000</sumStat>'
+        '<sumStat type="mean">%(i)s.5</sumStat>'
+        '<catgry><catValu>1</catValu><labl>Yes</labl></catgry>'
+        '<catgry><catValu>2</catValu><labl>No</labl></catgry>'
+        '</var>\n' % {'i': i}
+        for i in range(variables)
+    )
+    parts.append('</dataDscr>\n</codeBook>\n')
+    return ''.join(parts)
+
+
+def benchmark_fields(context_xml, rounds=10):
+    """
+    Returns the extraction time (in seconds) of every key of the
+    DDI mapping on the given codeBook element
+    """
+    ckan_metadata = metadata.DdiCkanMetadata()
+    costs = {}
+    for key in ckan_metadata.metadata:
+        attribute = ckan_metadata.get_attribute(key)
+        costs[key] = _time_rounds(
+            lambda: attribute.get_value(
+                metadata.ExtractionContext(context_xml)
+            ),
+            rounds
+        )
+    return costs
+
+
+class _Stub(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+class _OfflineNadaHarvester(NadaHarvester):
+    """
+    NADA harvester with all database access and CKAN actions stubbed
+    """
+    def _get_previous_extra(self, harvest_object, key):
+        return None
+
+    def _create_or_update_package(self, pkg_dict, harvest_object):
+        return True
+
+    def _save_object_error(self, message, harvest_object, stage=None):
+        raise BenchmarkError(message)
+
+
+def _offline_harvest_object(content):
+    source = _Stub(url='http://nada.example.org', config='{}')
+    return _Stub(
+        id='benchmark',
+        guid='1',
+        content=content,
+        extras=[],
+        harvest_source_id='benchmark',
+        harvest_job_id='benchmark',
+        package_id=None,
+        import_finished=None,
+        source=source,
+        job=_Stub(source=source)
+    )
+
+
+def benchmark_suite(variables=1000, keywords=10, nations=3, coll_dates=2,
+                    rounds=5):
+    """
+    Benchmark all steps of the import pipeline on a synthetic codebook.
+    Parse results are tuples (seconds, peak RSS increase in KB), all
+    other results are seconds per document.
+    """
+    xml_string = generate_ddi(variables, keywords, nations, coll_dates)
+    ckan_metadata = metadata.DdiCkanMetadata()
+    dataset_xml = etree.fromstring(xml_string)
+    context_xml = ckan_metadata.get_context_element(dataset_xml)
+    pkg_dict = ckan_metadata._extract(dataset_xml)
+    importer = DdiImporter()
+    harvester = _OfflineNadaHarvester()
+    content = xml_string.decode('utf-8')
+
+    return {
+        'size': len(xml_string),
+        'parse': _measure(lambda: etree.fromstring(xml_string)),
+        'parse_stream': _measure(
+            lambda: ckan_metadata.load_file(BytesIO(xml_string))
+        ),
+        'extract': _time_rounds(
+            lambda: ckan_metadata._extract(dataset_xml),
+            rounds
+        ),
+        'fields': benchmark_fields(context_xml, rounds),
+        'improve_pkg_dict': _time_rounds(
+            lambda: importer.improve_pkg_dict(dict(pkg_dict), None),
+            rounds
+        ),
+        'convert_to_extras': _time_rounds(
+            lambda: harvester._convert_to_extras(dict(pkg_dict)),
+            rounds
+        ),
+        'import_stage': _time_rounds(
+            lambda: harvester.import_stage(_offline_harvest_object(content)),
+            rounds
+        ),
+    }
+
+
+VARIABLE_QUERIES = ['v1', 'v12345', 'label', 'label of variable 99', 'none']
+
+
+def benchmark_variables(variables=10000, rounds=10):
+    """
+    Benchmark the extraction and search of the variables of a synthetic
+    codebook. The extraction into a VariableStore is compared with keeping
+    the variables as a list of dicts, as tuples (seconds, peak RSS increase
+    in KB). The sizes are in bytes, load and queries in seconds.
+    """
+    xml_string = generate_ddi(variables)
+    store = extract_variables(BytesIO(xml_string))
+    tmp_file, path = tempfile.mkstemp(suffix='.vars')
+    os.close(tmp_file)
+    try:
+        store.save(path)
+        results = {
+            'size': len(xml_string),
+            'variables': len(store),
+            'extract_store': _measure(
+                lambda: extract_variables(BytesIO(xml_string))
+            ),
+            'extract_dicts': _measure(
+                lambda: list(iter_variables(BytesIO(xml_string)))
+            ),
+            'store_size': os.path.getsize(path),
+            'json_size': len(json.dumps(
+                list(iter_variables(BytesIO(xml_string)))
+            )),
+            'load': _time_rounds(lambda: VariableStore.load(path), rounds),
+            'queries': {},
+        }
+    finally:
+        os.remove(path)
+
+    for query in VARIABLE_QUERIES:
+        results['queries'][query] = (
+            len(store.search(query)),
+            _time_rounds(
+                lambda: [
+                    store.get(position)
+                    for position in store.search(query)[:20]
+                ],
+                rounds
+            )
+        )
+    return results
+
+
+def _uncached_show_package_schema(plugin):
+    # the show schema as it was built before the entries of the DDI
+    # fields were cached
+    schema = super(plugins.DdiSchema, plugin).show_package_schema()
+    schema['tags']['__extras'].append(tk.get_converter('free_tags_only'))
+    fields = plugins.get_ddi_config()['fields']
+    for section in fields:
+        for field in fields[section]:
+            schema.update({
+                field: [tk.get_converter('convert_from_extras'),
+                        tk.get_validator('ignore_missing')]
+            })
+    return schema
+
+
+def benchmark_schema(dataset_id=None, rounds=1000):
+    """
+    Compare building the show schema of DdiSchema with and without the
+    cached entries of the DDI fields (seconds per schema). If a dataset is
+    given, the throughput of package_show (calls per second) is measured
+    as well, this requires the ddi_schema plugin to be enabled.
+    """
+    schema_plugin = plugins.DdiSchema()
+    results = {
+        'schema_uncached': _time_rounds(
+            lambda: _uncached_show_package_schema(schema_plugin),
+            rounds
+        ),
+        'schema_cached': _time_rounds(
+            schema_plugin.show_package_schema,
+            rounds
+        ),
+    }
+    if dataset_id is None:
+        return results
+
+    user = tk.get_action('get_site_user')({}, {})
+    package_show = tk.get_action('package_show')
+
+    def show():
+        package_show({'user': user['name']}, {'id': dataset_id})
+
+    package_plugin = lookup_package_plugin()
+    package_plugin.show_package_schema = (
+        lambda: _uncached_show_package_schema(package_plugin)
+    )
+    try:
+        results['package_show_uncached'] = 1 / _time_rounds(show, rounds)
+    finally:
+        # use the method of the class again
+        del package_plugin.show_package_schema
+    results['package_show_cached'] = 1 / _time_rounds(show, rounds)
+    return results
+
+
+FIELD_TYPES = ['text', 'url', 'email', 'markdown', 'vocabulary']
+
+
+def generate_ddi_config(sections=10, fields=50):
+    """
+    Returns a synthetic DDI config with fields of all types and a dataset
+    dict with values for all of its fields
+    """
+    ddi_config = {'sections': OrderedDict(), 'fields': OrderedDict()}
+    pkg_dict = {}
+    for i in range(sections):
+        section = 'section_%s' % i
+        ddi_config['sections'][section] = 'Section %s' % i
+        ddi_config['fields'][section] = OrderedDict()
+        for j in range(fields):
+            field = 'field_%s_%s' % (i, j)
+            field_type = FIELD_TYPES[j % len(FIELD_TYPES)]
+            ddi_config['fields'][section][field] = {
+                'type': field_type,
+                'visible': j % 10 != 9,
+                'display': 'Field %s of section %s' % (j, i),
+            }
+            if field_type == 'url':
+                pkg_dict[field] = 'http://example.com/%s' % field
+            elif field_type == 'email':
+                pkg_dict[field] = '%s@example.com' % field
+            else:
+                pkg_dict[field] = 'Value of %s' % field
+    return ddi_config, pkg_dict
+
+
+def benchmark_render(sections=10, fields=50, rounds=100):
+    """
+    Measure the time (in seconds) to render the additional info snippet of
+    the dataset page with a synthetic DDI config. The snippet is rendered
+    with a plain Jinja2 environment, markdown is not rendered.
+    """
+    ddi_config, pkg_dict = generate_ddi_config(sections, fields)
+    templates_dir = os.path.join(os.path.dirname(__file__), 'templates')
+    environment = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(templates_dir),
+        autoescape=True
+    )
+    template = environment.get_template(
+        'package/snippets/additional_info.html'
+    )
+    helpers = _Stub(
+        ddi_theme_get_ddi_config=lambda: ddi_config,
+        ddi_theme_get_display_plan=(
+            lambda: plugins.get_display_plan(ddi_config)
+        ),
+        ddi_theme_render_markdown=lambda pkg, field: pkg[field]
+    )
+    return _time_rounds(
+        lambda: template.render(pkg=pkg_dict, h=helpers, _=lambda s: s),
+        rounds
+    )
+
+
+class _NadaRequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 to allow clients to keep the connection alive, send the
+    # headers and body of a response in one write without delay
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        nada = self.server.nada
+        sleep(nada.latency)
+        url = urlparse.urlparse(self.path)
+        if url.path.startswith('/index.php/api/v2/catalog/search'):
+            query = urlparse.parse_qs(url.query)
+            page = int(query.get('page', ['1'])[0])
+            page_size = int(query.get('ps', [nada.page_size])[0])
+            self._respond(
+                json.dumps(nada.search_page(page, page_size)),
+                'application/json'
+            )
+        elif url.path.startswith('/index.php/catalog/ddi/'):
+            study_id = url.path.rsplit('/', 1)[1]
+            # the documents never change, so the study id is a valid ETag
+            etag = '"%s"' % study_id
+            if self.headers.get('If-None-Match') == etag:
+                self._respond_not_modified(etag)
+            else:
+                self._respond(nada.ddi(study_id), 'application/xml', etag)
+        else:
+            self.send_error(404)
+
+    def _respond(self, body, content_type, etag=None):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            # gzip format
+            compressor = zlib.compressobj(
+                6,
+                zlib.DEFLATED,
+                16 + zlib.MAX_WBITS
+            )
+            body = compressor.compress(body) + compressor.flush()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _respond_not_modified(self, etag):
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeNadaServer(object):
+    """
+    Local stand-in for a NADA instance, serving the catalog search API and
+    the synthetic DDI documents (with `variables` variables each) of
+    `studies` studies. Every response is delayed by `latency` seconds to
+    simulate a remote server.
+    """
+    def __init__(self, studies=100, page_size=15, latency=0.05, variables=0):
+        self.studies = studies
+        self.variables = variables
+        self.page_size = page_size
+        self.latency = latency
+        self._server = None
+
+    def search_page(self, page, page_size):
+        offset = (page - 1) * page_size
+        ids = range(offset + 1, min(offset + page_size, self.studies) + 1)
+        return {
+            'found': self.studies,
+            'limit': page_size,
+            'offset': offset,
+            'rows': [
+                {'id': str(study_id), 'changed': '1420070400'}
+                for study_id in ids
+            ],
+        }
+
+    def ddi(self, study_id):
+        return generate_ddi(variables=self.variables, study_id=study_id)
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self._server.server_address
+
+    def start(self):
+        self._server = _ThreadingHTTPServer(
+            ('127.0.0.1', 0),
+            _NadaRequestHandler
+        )
+        self._server.nada = self
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def benchmark_fetch(studies=100, concurrency=8, latency=0.05):
+    """
+    Measure the throughput (documents per second) of fetching DDI
+    documents from a local fake NADA server: with a new connection per
+    request, with the shared session, with concurrent requests and with
+    conditional requests for documents that were not modified.
+    """
+    nada = FakeNadaServer(studies=studies, latency=latency).start()
+    try:
+        urls = [
+            '%s/index.php/catalog/ddi/%s' % (nada.url, study_id)
+            for study_id in range(1, studies + 1)
+        ]
+
+        def unpooled():
+            for url in urls:
+                requests.get(url).text
+
+        def pooled():
+            for url in urls:
+                httpclient.fetch_text(url)
+
+        def concurrent():
+            httpclient.fetch_all(urls, concurrency)
+
+        etags = [httpclient.fetch_if_modified(url)[1] for url in urls]
+
+        def conditional():
+            for url, etag in zip(urls, etags):
+                httpclient.fetch_if_modified(url, etag)
+
+        return dict(
+            (name, studies / _time_rounds(func, 1))
+            for name, func in [
+                ('unpooled', unpooled),
+                ('pooled', pooled),
+                ('concurrent', concurrent),
+                ('conditional', conditional),
+            ]
+        )
+    finally:
+        # close the kept-alive connections to the fake server
+        httpclient.get_session().close()
+        nada.stop()
+
+
+def _get_search_rows(harvester, base_url):
+    """ Returns the rows of all pages of the catalog search """
+    rows = []
+    for page, page_rows in harvester._get_search_pages(base_url):
+        rows.extend(page_rows)
+    return rows
+
+
+def benchmark_gather(studies=1000, page_size=15, concurrency=8,
+                     latency=0.05):
+    """
+    Measure the time (in seconds) to get all rows of the catalog search
+    of a local fake NADA server, with sequential and concurrent requests
+    for the pages.
+    """
+    nada = FakeNadaServer(studies=studies, latency=latency).start()
+    try:
+        results = {}
+        for name, gather_concurrency in [('sequential', 1),
+                                         ('concurrent', concurrency)]:
+            harvester = NadaHarvester()
+            harvester.config = {
+                'page_size': page_size,
+                'gather_concurrency': gather_concurrency,
+            }
+            results[name] = _time_rounds(
+                lambda: _get_search_rows(harvester, nada.url),
+                1
+            )
+        return results
+    finally:
+        httpclient.get_session().close()
+        nada.stop()
@@ -0,0 +1,223 @@
+"""
+On-disk cache of fetched DDI documents
+"""
+import gzip
+import hashlib
+import json
+import os
+import threading
+import uuid
+
+import ckan.plugins.toolkit as tk
+from pylons import config
+
+import logging
+log = logging.getLogger(__name__)
+
+# default of ckanext.ddi.cache_max_size (1 GB)
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+# on eviction, documents are removed until the cache is below this
+# fraction of its maximum size, so not every new document evicts another
+EVICTION_TARGET = 0.9
+
+
+class DocumentCache(object):
+    """
+    Content-addressed cache of documents: every document is stored once
+    under the SHA-1 of its content (optionally gzip-compressed). Keys like
+    URLs are mapped to a content hash and the HTTP validators of the
+    response it came from.
+
+    If the cache grows beyond `max_size` bytes, the least recently used
+    documents are removed.
+    """
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE, compress=False):
+        self.directory = directory
+        self.max_size = max_size
+        self.compress = compress
+        self._objects_dir = os.path.join(directory, 'objects')
+        self._keys_dir = os.path.join(directory, 'keys')
+        for path in (self._objects_dir, self._keys_dir):
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    # created by another process in the meantime
+                    if not os.path.isdir(path):
+                        raise
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _object_path(self, content_hash, compressed):
+        filename = content_hash + ('.gz' if compressed else '')
+        return os.path.join(self._objects_dir, content_hash[:2], filename)
+
+    def _find(self, content_hash):
+        for compressed in (self.compress, not self.compress):
+            path = self._object_path(content_hash, compressed)
+            if os.path.exists(path):
+                return path, compressed
+        return None, None
+
+    def put(self, content):
+        """ Store the document (a byte string), returns its hash """
+        content_hash = hashlib.sha1(content).hexdigest()
+        path, compressed = self._find(content_hash)
+        if path is not None:
+            self._touch(path)
+            return content_hash
+
+        path = self._object_path(content_hash, self.compress)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+        self._write(path, content)
+        self._add_size(os.path.getsize(path))
+        return content_hash
+
+    def _write(self, path, content):
+        # written to a temporary file first, so other processes never
+        # read a partial document
+        tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        if self.compress:
+            with open(tmp_path, 'wb') as tmp_file:
+                gzip_file = gzip.GzipFile(fileobj=tmp_file, mode='wb')
+                gzip_file.write(content)
+                gzip_file.close()
+        else:
+            with open(tmp_path, 'wb') as tmp_file:
+                tmp_file.write(content)
+        os.rename(tmp_path, path)
+
+    def open(self, content_hash):
+        """
+        Returns the document as file-like object, None if it is not
+        (or no longer) in the cache
+        """
+        path, compressed = self._find(content_hash)
+        if path is None:
+            return None
+        try:
+            self._touch(path)
+            if compressed:
+                return gzip.GzipFile(path, 'rb')
+            return open(path, 'rb')
+        except (IOError, OSError):
+            # evicted in the meantime
+            return None
+
+    def get(self, content_hash):
+        """ Returns the document as byte string, None if it is not cached """
+        document = self.open(content_hash)
+        if document is None:
+            return None
+        with document:
+            return document.read()
+
+    def _key_path(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        key_hash = hashlib.sha1(key).hexdigest()
+        return os.path.join(self._keys_dir, '%s.json' % key_hash)
+
+    def set_key(self, key, content_hash, etag=None, last_modified=None):
+        path = self._key_path(key)
+        tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        with open(tmp_path, 'w') as key_file:
+            json.dump({
+                'hash': content_hash,
+                'etag': etag,
+                'last_modified': last_modified,
+            }, key_file)
+        os.rename(tmp_path, path)
+
+    def get_key(self, key):
+        """
+        Returns a dict with the content hash (`hash`) and the validators
+        (`etag`, `last_modified`) stored for the key, None if unknown
+        """
+        try:
+            with open(self._key_path(key)) as key_file:
+                return json.load(key_file)
+        except (IOError, ValueError):
+            return None
+
+    def _touch(self, path):
+        # the modification time is the time of the last use
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def _add_size(self, size):
+        with self._lock:
+            if self._size is None:
+                # the new document is included in the scan
+                self._size = sum(entry[1] for entry in self._scan())
+            else:
+                self._size += size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _scan(self):
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self._objects_dir):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _evict(self):
+        # the cache directory may be shared by several processes, so the
+        # actual size is determined before removing anything
+        entries = sorted(self._scan(), key=lambda entry: entry[2])
+        size = sum(entry[1] for entry in entries)
+        target = self.max_size * EVICTION_TARGET
+        for path, entry_size, mtime in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+                size -= entry_size
+            except OSError:
+                pass
+        log.debug('Document cache evicted to %s bytes' % size)
+        self._size = size
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Returns the process-wide document cache, None if
+    `ckanext.ddi.cache_dir` is not set
+    """
+    global _cache
+    cache_dir = config.get('ckanext.ddi.cache_dir')
+    if not cache_dir:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = DocumentCache(
+                    cache_dir,
+                    max_size=int(config.get(
+                        'ckanext.ddi.cache_max_size',
+                        DEFAULT_MAX_SIZE
+                    )),
+                    compress=tk.asbool(
+                        config.get('ckanext.ddi.cache_compress', False)
+                    )
+                )
+    return _cache
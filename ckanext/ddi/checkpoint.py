@@ -0,0 +1,46 @@
+"""
+Checkpoint files to resume long running jobs
+"""
+import os
+import threading
+
+
+class Checkpoint(object):
+    """
+    Append-only record of completed keys (e.g. file paths) in a text file,
+    one key per line. Every key is written as soon as it is added, so a
+    restarted job can skip everything that was completed before.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._done = set()
+        if os.path.exists(path):
+            with open(path) as checkpoint_file:
+                self._done = set(
+                    line.rstrip('\n') for line in checkpoint_file
+                    if line.strip()
+                )
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def _encode(self, key):
+        if isinstance(key, unicode):
+            return key.encode('utf-8')
+        return key
+
+    def __contains__(self, key):
+        return self._encode(key) in self._done
+
+    def __len__(self):
+        return len(self._done)
+
+    def add(self, key):
+        key = self._encode(key)
+        with self._lock:
+            if key not in self._done:
+                self._file.write(key + '\n')
+                self._file.flush()
+                self._done.add(key)
+
+    def close(self):
+        self._file.close()
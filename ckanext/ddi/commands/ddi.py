@@ -1,9 +1,13 @@
 import ckan.lib.cli
 import sys
 import json
+from multiprocessing import cpu_count
 from pprint import pprint
 
-from ckanext.ddi.importer import ddiimporter
+from ckanext.ddi import jobs
+from ckanext.ddi.checkpoint import Checkpoint
+from ckanext.ddi.indexing import DeferredIndexer
+from ckanext.ddi.importer import ddiimporter, bulkimporter
 from ckanext.ddi.plugins import get_ddi_config
 
 import logging
@@ -27,16 +31,88 @@ class DdiCommand(ckan.lib.cli.CkanCommand):
         # Import datasets
         paster --plugin=ckanext-ddi ddi import <path_or_url> <license>
 
+        # Import all DDI files of a directory, a glob pattern or a manifest
+        # file (one path per line)
+        paster --plugin=ckanext-ddi ddi import-dir <dir|glob|manifest>
+            [<license>] [--workers=<n>] [--checkpoint=<file>]
+            [--index-batch-size=<n>]
+
+        # Run the import jobs of the web interface
+        paster --plugin=ckanext-ddi ddi jobs-worker
+
+        # Benchmark the metadata extraction of a DDI file
+        paster --plugin=ckanext-ddi ddi benchmark <path> [<rounds>]
+
+        # Benchmark fetching DDI files from a local fake NADA server
+        paster --plugin=ckanext-ddi ddi benchmark-fetch [<studies>]
+            [<concurrency>]
+
+        # Benchmark the catalog search of the NADA harvester against a local
+        # fake NADA server
+        paster --plugin=ckanext-ddi ddi benchmark-gather [<studies>]
+            [<page_size>] [<concurrency>]
+
+        # Benchmark all steps of the import on synthetic DDI files, the
+        # number of variables can be a comma-separated list of sizes
+        paster --plugin=ckanext-ddi ddi benchmark-suite [<variables>]
+            [<keywords>] [<nations>] [<coll_dates>] [<rounds>]
+
+        # Benchmark the extraction and search of variables on a synthetic
+        # DDI file
+        paster --plugin=ckanext-ddi ddi benchmark-variables [<variables>]
+            [<rounds>]
+
+        # Benchmark building the dataset schema and package_show
+        paster --plugin=ckanext-ddi ddi benchmark-schema [<dataset>]
+            [<rounds>]
+
+        # Benchmark rendering the DDI fields of the dataset page with a
+        # synthetic DDI config
+        paster --plugin=ckanext-ddi ddi benchmark-render [<sections>]
+            [<fields>] [<rounds>]
+
     '''
     summary = __doc__.split('\n')[0]
     usage = __doc__
 
+    def __init__(self, name):
+        super(DdiCommand, self).__init__(name)
+
+        self.parser.add_option(
+            '--workers', dest='workers', type='int', default=cpu_count(),
+            help='Number of processes to parse DDI files (import-dir)'
+        )
+        self.parser.add_option(
+            '--index-batch-size', dest='index_batch_size', type='int',
+            default=100,
+            help=(
+                'Number of datasets that are indexed at once (import-dir), '
+                '0 to index every dataset when it is imported'
+            )
+        )
+        self.parser.add_option(
+            '--checkpoint', dest='checkpoint', default=None,
+            help=(
+                'File to record imported files in, an interrupted '
+                'import-dir resumes from it when it is run again'
+            )
+        )
+
     def command(self):
         # load pylons config
         self._load_config()
         options = {
             'import': self.importCmd,
+            'import-dir': self.importDirCmd,
+            'jobs-worker': self.jobsWorkerCmd,
             'config': self.configCmd,
+            'benchmark': self.benchmarkCmd,
+            'benchmark-fetch': self.benchmarkFetchCmd,
+            'benchmark-gather': self.benchmarkGatherCmd,
+            'benchmark-suite': self.benchmarkSuiteCmd,
+            'benchmark-variables': self.benchmarkVariablesCmd,
+            'benchmark-schema': self.benchmarkSchemaCmd,
+            'benchmark-render': self.benchmarkRenderCmd,
             'help': self.helpCmd,
         }
 
@@ -78,3 +154,165 @@ class DdiCommand(ckan.lib.cli.CkanCommand):
         except Exception:
             import traceback
             traceback.print_exc()
+
+    def importDirCmd(self, source=None, license=None):
+        if source is None:
+            print "Argument 'dir|glob|manifest' must be set"
+            self.helpCmd()
+            sys.exit(1)
+
+        checkpoint = None
+        if self.options.checkpoint:
+            checkpoint = Checkpoint(self.options.checkpoint)
+        indexer = None
+        if self.options.index_batch_size > 0:
+            indexer = DeferredIndexer(self.options.index_batch_size)
+        bulk_importer = bulkimporter.BulkImporter(
+            ddiimporter.DdiImporter(indexer=indexer),
+            workers=self.options.workers,
+            checkpoint=checkpoint,
+            progress=self._print_progress
+        )
+        try:
+            bulk_importer.run(
+                bulkimporter.find_files(source),
+                params={'license': license}
+            )
+        finally:
+            if indexer is not None:
+                indexer.flush()
+            if checkpoint is not None:
+                checkpoint.close()
+
+        print '\nImported: %s' % bulk_importer.imported
+        print 'Skipped (already imported): %s' % bulk_importer.skipped
+        print 'Failed: %s' % len(bulk_importer.failed)
+        for file_path, error in bulk_importer.failed:
+            print '    %s: %s' % (file_path, error)
+
+    def _print_progress(self, bulk_importer):
+        sys.stdout.write(
+            '\r%s/%s files processed (%s failed)' % (
+                bulk_importer.processed,
+                bulk_importer.total,
+                len(bulk_importer.failed),
+            )
+        )
+        sys.stdout.flush()
+
+    def jobsWorkerCmd(self):
+        # the jobs run in this process, not in additional threads
+        jobs.create_queue(workers=0).work()
+
+    def benchmarkCmd(self, path=None, rounds=10):
+        # loaded only by the benchmark commands, not by every command
+        from ckanext.ddi import benchmark
+        if path is None:
+            print "Argument 'path' must be set"
+            self.helpCmd()
+            sys.exit(1)
+        with open(path) as xml_file:
+            xml_string = xml_file.read()
+        results = benchmark.benchmark_xpath(xml_string, int(rounds))
+        print 'XPath expressions in mapping: %s' % results['expressions']
+        names = ['uncompiled_xpath', 'compiled_xpath', 'load', 'load_file']
+        for name in names:
+            print '%-18s %10.3f ms/document' % (name, results[name] * 1000)
+
+    def benchmarkFetchCmd(self, studies=100, concurrency=8):
+        from ckanext.ddi import benchmark
+        results = benchmark.benchmark_fetch(int(studies), int(concurrency))
+        for name in ['unpooled', 'pooled', 'concurrent', 'conditional']:
+            print '%-12s %10.1f documents/s' % (name, results[name])
+
+    def benchmarkGatherCmd(self, studies=1000, page_size=15, concurrency=8):
+        from ckanext.ddi import benchmark
+        results = benchmark.benchmark_gather(
+            int(studies),
+            int(page_size),
+            int(concurrency)
+        )
+        for name in ['sequential', 'concurrent']:
+            print '%-12s %10.3f s' % (name, results[name])
+
+    def benchmarkSuiteCmd(self, variables='100,1000,10000', keywords=10,
+                          nations=3, coll_dates=2, rounds=5):
+        from ckanext.ddi import benchmark
+        for variable_count in variables.split(','):
+            results = benchmark.benchmark_suite(
+                int(variable_count),
+                int(keywords),
+                int(nations),
+                int(coll_dates),
+                int(rounds)
+            )
+            print '\n%s variables (%s bytes)' % (
+                variable_count,
+                results['size']
+            )
+            for name in ['parse', 'parse_stream']:
+                seconds, rss = results[name]
+                print '%-20s %10.3f ms %10s KB peak RSS' % (
+                    name,
+                    seconds * 1000,
+                    rss
+                )
+            for name in ['extract', 'improve_pkg_dict', 'convert_to_extras',
+                         'import_stage']:
+                print '%-20s %10.3f ms' % (name, results[name] * 1000)
+            print 'Extraction time per field:'
+            fields = sorted(
+                results['fields'].items(),
+                key=lambda item: item[1],
+                reverse=True
+            )
+            for key, seconds in fields:
+                print '    %-24s %10.3f ms' % (key, seconds * 1000)
+
+    def benchmarkVariablesCmd(self, variables=10000, rounds=10):
+        from ckanext.ddi import benchmark
+        results = benchmark.benchmark_variables(int(variables), int(rounds))
+        print '%s variables (%s bytes)' % (
+            results['variables'],
+            results['size']
+        )
+        for name in ['extract_store', 'extract_dicts']:
+            seconds, rss = results[name]
+            print '%-20s %10.3f ms %10s KB peak RSS' % (
+                name,
+                seconds * 1000,
+                rss
+            )
+        for name in ['store_size', 'json_size']:
+            print '%-20s %10s bytes' % (name, results[name])
+        print '%-20s %10.3f ms' % ('load', results['load'] * 1000)
+        print 'Query latency (first 20 results):'
+        for query in benchmark.VARIABLE_QUERIES:
+            count, seconds = results['queries'][query]
+            print '    %-24s %10.3f ms %8s matches' % (
+                repr(query),
+                seconds * 1000,
+                count
+            )
+
+    def benchmarkSchemaCmd(self, dataset=None, rounds=1000):
+        from ckanext.ddi import benchmark
+        results = benchmark.benchmark_schema(dataset, int(rounds))
+        for name in ['schema_uncached', 'schema_cached']:
+            print '%-24s %10.3f ms' % (name, results[name] * 1000)
+        for name in ['package_show_uncached', 'package_show_cached']:
+            if name in results:
+                print '%-24s %10.1f calls/s' % (name, results[name])
+
+    def benchmarkRenderCmd(self, sections=10, fields=50, rounds=100):
+        from ckanext.ddi import benchmark
+        seconds = benchmark.benchmark_render(
+            int(sections),
+            int(fields),
+            int(rounds)
+        )
+        print '%s sections with %s fields: %.3f ms per render' % (
+            sections,
+            fields,
+            seconds * 1000
+        )
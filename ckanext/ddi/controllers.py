@@ -1,9 +1,6 @@
 from ckan.controllers.package import PackageController
 
 import logging
-import shutil
-import tempfile
-import os
 
 import ckan.logic as logic
 import ckan.lib.base as base
@@ -16,7 +13,7 @@ import ckan.lib.render
 from ckan.common import _, request, c
 from ckan.controllers.home import CACHE_PARAMETERS
 
-from ckanext.ddi.importer import ddiimporter
+from ckanext.ddi import jobs
 
 log = logging.getLogger(__name__)
 
@@ -100,56 +97,62 @@ class ImportFromXml(PackageController):
                                   'dataset_type': package_type})
 
     def run_import(self, data=None, errors=None, error_summary=None):
-        pkg_id = None
-        file_path = None
+        job = None
         try:
             user = c.user or c.author
-            importer = ddiimporter.DdiImporter(username=user)
-
+            # the import runs in the background, the user is redirected to
+            # the status page of the job
             if request.params['upload'] != '':
                 log.debug('upload: %s' % request.params['upload'])
-                file_path = self._save_temp_file(request.params['upload'].file)
-                log.debug('file_path: %s' % file_path)
-                pkg_id = importer.run(
-                    file_path=file_path,
+                job = jobs.enqueue_import(
+                    user,
                     upload=request.params['upload']
                 )
             elif 'url' in request.params and request.params['url']:
                 log.debug('url: %s' % request.params['url'])
-                pkg_id = importer.run(url=request.params['url'])
+                job = jobs.enqueue_import(user, url=request.params['url'])
 
-            if pkg_id is None:
+            if job is None:
                 raise PackageImportError(
-                    'Could not import package (%s / %s / %s)'
+                    'Could not import package (%s / %s)'
                     % (
                         request.params.get('upload'),
-                        file_path,
                         request.params.get('url')
                     )
                 )
-
-            h.flash_success(
-                _('Dataset import from XML successfully completed!')
-            )
         except Exception as e:
             h.flash_error(
                 _('Dataset import from XML failed: %s' % str(e))
             )
-        finally:
-            if file_path is not None:
-                os.remove(file_path)
 
-        if pkg_id is not None:
-            redirect(h.url_for(controller='package', action='read', id=pkg_id))
+        if job is not None:
+            redirect(h.url_for('ddi_import_status', id=job['id']))
         else:
             redirect(h.url_for(controller='package', action='search'))
 
-    def _save_temp_file(self, fileobj):
-        fd, file_path = tempfile.mkstemp()
-        with os.fdopen(fd, 'w') as output_file:
-            fileobj.seek(0)
-            shutil.copyfileobj(fileobj, output_file)
-        return file_path
+    def import_status(self, id):
+        store = jobs.get_store()
+        job = store.get(id)
+        # jobs are only visible to the user who started them
+        user = c.user or c.author
+        if job is None or (job['user'] != user and
+                           not (c.userobj and c.userobj.sysadmin)):
+            abort(404, _('Import job not found'))
+        job = store.check_interrupted(job)
+        # make sure the local workers of this process run, they pick up
+        # jobs queued by processes that were stopped in the meantime
+        jobs.get_queue()
+
+        if job['state'] == jobs.DONE:
+            h.flash_success(
+                _('Dataset import from XML successfully completed!')
+            )
+            redirect(h.url_for(
+                controller='package',
+                action='read',
+                id=job['result']
+            ))
+        return render('package/import_status.html', extra_vars={'job': job})
 
 
 class PackageImportError(Exception):
@@ -1,19 +1,36 @@
 # -*- coding: utf-8 -*-
 
-import requests
+import hashlib
+import math
+import os
 import traceback
+from io import BytesIO
+from multiprocessing import Pool, TimeoutError
+
+from ckan import model
 
 from ckan.lib.helpers import json
 from ckan.lib.munge import munge_tag
-from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestObject, HarvestObjectExtra
 from ckanext.harvest.harvesters import HarvesterBase
-from ckanext.ddi.importer import DdiCkanMetadata
+from ckanext.ddi.cache import get_cache
+from ckanext.ddi.checkpoint import Checkpoint
+from ckanext.ddi.importer import DdiCkanMetadata, variables
+from ckanext.ddi.importer.profiling import ExtractionProfile, StatsdSink
+from ckanext.ddi.httpclient import (
+    fetch_text, fetch_if_modified, fetch_all, fetch_all_if_modified
+)
+from ckanext.ddi.indexing import DeferredIndexer, automatic_indexing_disabled
 
 from pylons import config
 
 import logging
 log = logging.getLogger(__name__)
 
+# prefix of the content of harvest objects whose DDI file is stored in
+# the document cache, followed by the hash of the file
+CACHE_REFERENCE = 'ddi-cache:'
+
 
 class NadaHarvester(HarvesterBase):
     '''
@@ -49,6 +66,29 @@ class NadaHarvester(HarvesterBase):
         'extras',
     ]
 
+    # number of harvest objects that are created (and prefetched) at once
+    INSERT_CHUNK_SIZE = 100
+
+    # (harvest job id, ExtractionProfile) of the job currently imported
+    _job_profile = (None, None)
+
+    # (number of processes, Pool) to parse the DDI files if the
+    # `parse_processes` option is set, and the pending results by
+    # harvest object id
+    _parse_pool = (None, None)
+    _parsing = {}
+    _parse_processes_warned = False
+
+    # id of the harvest object that replaced the previous one in the last
+    # fetch stage of this process, as its content is unchanged
+    _replaced_object_id = None
+
+    # default of the `parse_timeout` option (seconds)
+    DEFAULT_PARSE_TIMEOUT = 300
+
+    # (harvest job id, DeferredIndexer) if the `defer_indexing` option is set
+    _job_indexer = (None, None)
+
     def info(self):
         return {
             'name': 'nada',
@@ -97,58 +137,542 @@ class NadaHarvester(HarvesterBase):
 
     def gather_stage(self, harvest_job):
         log.debug('In NadaHarvester gather_stage')
-        api_url = None
+        base_url = None
+        checkpoint = None
 
         try:
-            continue_gather = True
-            page = 1
-            harvest_obj_ids = []
-            while continue_gather:
-                self._set_config(harvest_job.source.config)
-                base_url = harvest_job.source.url.rstrip('/')
-
-                try:
-                    api_url = base_url + self._get_search_api(
-                        self.config['access_type'],
-                        page
-                    )
-                except (AccessTypeNotAvailableError, KeyError):
-                    api_url = base_url + self._get_search_api(
-                        'public_use',
-                        page
-                    )
-
-                log.debug('Gather datasets from: %s' % api_url)
-
-                headers = {
-                    'User-agent': 'Mozilla/5.0'
-                }
-                r = requests.get(api_url, headers=headers)
-                data = r.json()
-
-                log.debug('JSON data from %s: %r' % (api_url, data))
-
-                for row in data['rows']:
-                    harvest_obj = HarvestObject(
-                        guid=row['id'],
-                        job=harvest_job
-                    )
-                    harvest_obj.save()
-                    harvest_obj_ids.append(harvest_obj.id)
-                page += 1
-                row_count = int(data['offset']) + int(data['limit'])
-                continue_gather = row_count < int(data['found'])
+            self._set_config(harvest_job.source.config)
+            base_url = harvest_job.source.url.rstrip('/')
 
+            checkpoint = self._get_gather_checkpoint(harvest_job.id)
+            pages = self._get_search_pages(base_url, checkpoint or ())
+            self._gather_pages(harvest_job, base_url, pages, checkpoint)
+
+            # objects of an earlier, interrupted run of this job that were
+            # never fetched are returned as well
+            harvest_obj_ids = self._get_waiting_object_ids(harvest_job.id)
             log.debug('IDs: %r' % harvest_obj_ids)
+            if checkpoint is not None:
+                checkpoint.close()
+                os.remove(checkpoint.path)
 
             return harvest_obj_ids
         except Exception, e:
+            # the checkpoint is kept to resume the job
+            if checkpoint is not None:
+                checkpoint.close()
             self._save_gather_error(
                 'Unable to get content for URL: %s: %s / %s'
-                % (api_url, str(e), traceback.format_exc()),
+                % (base_url, str(e), traceback.format_exc()),
                 harvest_job
             )
 
+    def _get_search_url(self, base_url, page):
+        try:
+            api_url = base_url + self._get_search_api(
+                self.config['access_type'],
+                page
+            )
+        except (AccessTypeNotAvailableError, KeyError):
+            api_url = base_url + self._get_search_api(
+                'public_use',
+                page
+            )
+        if 'page_size' in self.config:
+            api_url += '&ps=%s' % int(self.config['page_size'])
+        return api_url
+
+    def _get_search_pages(self, base_url, completed_pages=()):
+        '''
+        Returns a list of (page number, rows) of the catalog search,
+        without the pages in `completed_pages`. The first page determines
+        the number of pages, the remaining pages are requested with up to
+        `gather_concurrency` concurrent requests.
+        '''
+        api_url = self._get_search_url(base_url, 1)
+        log.debug('Gather datasets from: %s' % api_url)
+        timeout = self._get_timeout()
+        data = json.loads(fetch_text(api_url, timeout=timeout))
+        pages = [(1, list(data['rows']))]
+
+        page_count = int(math.ceil(
+            float(data['found']) / max(int(data['limit']), 1)
+        ))
+        page_numbers = [
+            page for page in range(2, page_count + 1)
+            if str(page) not in completed_pages
+        ]
+        urls = [
+            self._get_search_url(base_url, page) for page in page_numbers
+        ]
+        concurrency = int(self.config.get('gather_concurrency', 1))
+        log.debug(
+            'Gather %s more pages with %s concurrent requests'
+            % (len(urls), concurrency)
+        )
+        results = fetch_all(urls, concurrency, timeout=timeout)
+        for page, url, (text, error) in zip(page_numbers, urls, results):
+            if error is not None:
+                raise error
+            page_rows = json.loads(text)['rows']
+            log.debug('Got %s rows from %s' % (len(page_rows), url))
+            pages.append((page, page_rows))
+        return [
+            (page, rows) for page, rows in pages
+            if str(page) not in completed_pages
+        ]
+
+    def _gather_pages(self, harvest_job, base_url, pages, checkpoint=None):
+        '''
+        Creates the harvest objects for the changed studies of the pages.
+        The objects are committed in batches of at least INSERT_CHUNK_SIZE
+        rows, after each batch its pages are added to the checkpoint.
+        Studies that already have an object in this job (i.e. of an
+        interrupted earlier run) are skipped.
+        '''
+        previous_changed = self._get_current_extras(
+            harvest_job.source.id,
+            'nada_changed'
+        )
+        previous_config = self._get_current_extras(
+            harvest_job.source.id,
+            'config_hash'
+        )
+        validators = self._get_previous_validators(
+            harvest_job.source.id,
+            previous_config
+        )
+        gathered_guids = self._get_gathered_guids(harvest_job.id)
+        found = 0
+        created = 0
+        batch_pages = []
+        batch_rows = []
+        for i, (page, rows) in enumerate(pages):
+            found += len(rows)
+            batch_pages.append(page)
+            batch_rows.extend(
+                row for row in self._get_changed_rows(
+                    rows,
+                    previous_changed,
+                    previous_config
+                )
+                if unicode(row['id']) not in gathered_guids
+            )
+            if len(batch_rows) < self.INSERT_CHUNK_SIZE and \
+                    i < len(pages) - 1:
+                continue
+            created += len(self._create_harvest_objects(
+                harvest_job,
+                base_url,
+                batch_rows,
+                validators
+            ))
+            if checkpoint is not None:
+                for batch_page in batch_pages:
+                    checkpoint.add(str(batch_page))
+            batch_pages = []
+            batch_rows = []
+        log.info(
+            'Found %s studies, %s of them changed since the last import'
+            % (found, created)
+        )
+
+    def _get_gather_checkpoint(self, job_id):
+        '''
+        Returns the checkpoint of the search pages that were gathered for
+        the job, None if `ckanext.ddi.checkpoint_dir` is not set
+        '''
+        checkpoint_dir = config.get('ckanext.ddi.checkpoint_dir')
+        if not checkpoint_dir:
+            return None
+        if not os.path.isdir(checkpoint_dir):
+            try:
+                os.makedirs(checkpoint_dir)
+            except OSError:
+                # created by another process in the meantime
+                if not os.path.isdir(checkpoint_dir):
+                    raise
+        return Checkpoint(
+            os.path.join(checkpoint_dir, 'gather-%s.txt' % job_id)
+        )
+
+    def _get_gathered_guids(self, job_id):
+        query = model.Session.query(HarvestObject.guid).filter(
+            HarvestObject.harvest_job_id == job_id
+        )
+        return set(guid for (guid,) in query)
+
+    def _get_waiting_object_ids(self, job_id):
+        query = model.Session.query(HarvestObject.id).filter(
+            HarvestObject.harvest_job_id == job_id,
+            HarvestObject.state == 'WAITING'
+        ).order_by(HarvestObject.gathered, HarvestObject.id)
+        return [obj_id for (obj_id,) in query]
+
+    def _create_harvest_objects(self, harvest_job, base_url, rows,
+                                validators=None):
+        '''
+        Creates and commits the harvest objects for the rows,
+        returns the ids of the new objects. validators are the ETag and
+        Last-Modified header by guid for the prefetch, see
+        _get_previous_validators.
+        '''
+        harvest_obj_ids = []
+        for i in range(0, len(rows), self.INSERT_CHUNK_SIZE):
+            chunk = rows[i:i + self.INSERT_CHUNK_SIZE]
+            contents = self._prefetch_contents(base_url, chunk, validators)
+            config_hash = self._get_config_hash()
+            harvest_objs = []
+            for row, (content, etag, last_modified) in zip(chunk, contents):
+                harvest_obj = HarvestObject(
+                    guid=row['id'],
+                    job=harvest_job,
+                    content=self._cache_content(content)
+                )
+                self._set_validators(harvest_obj, etag, last_modified)
+                harvest_obj.extras.append(HarvestObjectExtra(
+                    key='config_hash',
+                    value=config_hash
+                ))
+                if row.get('changed'):
+                    harvest_obj.extras.append(HarvestObjectExtra(
+                        key='nada_changed',
+                        value=unicode(row['changed'])
+                    ))
+                harvest_objs.append(harvest_obj)
+            model.Session.add_all(harvest_objs)
+            model.Session.flush()
+            for harvest_obj in harvest_objs:
+                harvest_obj_ids.append(harvest_obj.id)
+                # the content is written to the database, release it
+                model.Session.expire(harvest_obj, ['content'])
+        model.Session.commit()
+        return harvest_obj_ids
+
+    def _is_incremental(self):
+        return self.config.get('incremental', True)
+
+    def _is_completed(self, harvest_object):
+        '''
+        True if the object was already imported, i.e. it was queued again
+        after its job was interrupted. Only checked in the fetch stage, the
+        import stage runs for imported objects as well when they are
+        re-imported (`paster harvester import`).
+        '''
+        if harvest_object.import_finished is not None:
+            log.debug(
+                'Object %s was already imported, skip it'
+                % harvest_object.guid
+            )
+            return True
+        return False
+
+    def _get_config_hash(self):
+        '''
+        Returns a hash of the source config options that change the
+        imported datasets, a study is imported again if they changed
+        '''
+        return hashlib.sha1(json.dumps(
+            {'license_id': self._get_license_id()},
+            sort_keys=True
+        )).hexdigest()
+
+    def _get_timeout(self):
+        # None to use the default of the HTTP client
+        return self.config.get('timeout')
+
+    def _get_current_extras(self, source_id, key):
+        '''
+        Returns a dict guid -> value of the harvest object extra `key` for
+        all current harvest objects of the source whose dataset is active,
+        studies with a deleted dataset are imported again
+        '''
+        query = model.Session.query(
+            HarvestObject.guid,
+            HarvestObjectExtra.value
+        ).join(
+            HarvestObjectExtra,
+            HarvestObjectExtra.harvest_object_id == HarvestObject.id
+        ).join(
+            model.Package,
+            HarvestObject.package_id == model.Package.id
+        ).filter(
+            HarvestObject.current == True,  # noqa
+            HarvestObject.harvest_source_id == source_id,
+            HarvestObjectExtra.key == key,
+            model.Package.state == 'active'
+        )
+        return dict(query)
+
+    def _get_previous_extra(self, harvest_object, key):
+        '''
+        Returns the value of the extra `key` of the current harvest object
+        with the same guid (i.e. of the last successful import), None if
+        there is no such object or extra
+        '''
+        query = model.Session.query(HarvestObjectExtra.value).join(
+            HarvestObject,
+            HarvestObjectExtra.harvest_object_id == HarvestObject.id
+        ).filter(
+            HarvestObject.guid == harvest_object.guid,
+            HarvestObject.current == True,  # noqa
+            HarvestObject.id != harvest_object.id,
+            HarvestObject.harvest_source_id ==
+            harvest_object.harvest_source_id,
+            HarvestObjectExtra.key == key
+        )
+        row = query.first()
+        return row[0] if row else None
+
+    def _get_previous_validators(self, source_id, previous_config):
+        '''
+        Returns a dict guid -> (etag, last_modified) of the DDI files of
+        the last imports that are still valid (see
+        _is_previous_import_valid), empty if the documents are not
+        prefetched in the gather stage
+        '''
+        if not self._is_incremental() or self._get_fetch_concurrency() <= 1:
+            return {}
+        config_hash = self._get_config_hash()
+        etags = self._get_current_extras(source_id, 'etag')
+        last_modified = self._get_current_extras(source_id, 'last_modified')
+        return dict(
+            (guid, (etags.get(guid), last_modified.get(guid)))
+            for guid in set(etags) | set(last_modified)
+            if previous_config.get(guid) == config_hash
+        )
+
+    def _get_changed_rows(self, rows, previous_changed, previous_config):
+        '''
+        Returns the search result rows that changed since the last import,
+        based on the `changed` timestamp of NADA and the hash of the source
+        config the study was imported with (both by guid)
+        '''
+        if not self._is_incremental():
+            return rows
+        config_hash = self._get_config_hash()
+        changed_rows = []
+        for row in rows:
+            guid = unicode(row['id'])
+            changed = row.get('changed')
+            if changed and \
+                    previous_changed.get(guid) == unicode(changed) and \
+                    previous_config.get(guid) == config_hash:
+                log.debug('Study %s has not changed, skip it' % row['id'])
+                continue
+            changed_rows.append(row)
+        return changed_rows
+
+    def _is_previous_import_valid(self, harvest_object):
+        '''
+        True if the last import of the study can be kept if its DDI file
+        did not change: it was imported with the same source config and its
+        dataset was not deleted
+        '''
+        return (
+            self._get_previous_extra(harvest_object, 'config_hash') ==
+            self._get_config_hash() and
+            self._get_previous_package_state(harvest_object) == 'active'
+        )
+
+    def _content_unchanged(self, harvest_object):
+        '''
+        Stores the hash of the content as extra of the harvest object and
+        returns True if it is the same as the one of the last import
+        '''
+        if harvest_object.content is None:
+            # not modified since the last import, see _fetch_content
+            return True
+        content_hash = hashlib.sha1(
+            harvest_object.content.encode('utf-8')
+        ).hexdigest()
+        self._set_extra(harvest_object, 'content_hash', content_hash)
+        self._set_extra(harvest_object, 'config_hash', self._get_config_hash())
+        if not self._is_incremental():
+            return False
+        return (
+            self._get_previous_extra(harvest_object, 'content_hash') ==
+            content_hash and
+            self._is_previous_import_valid(harvest_object)
+        )
+
+    def _pkg_dict_unchanged(self, harvest_object, pkg_dict):
+        '''
+        Stores a hash of the dataset dict as extra of the harvest object and
+        returns True if it is the same as the one of the last import and the
+        dataset still exists, i.e. the dataset does not need to be updated
+        '''
+        pkg_hash = hashlib.sha1(json.dumps(
+            pkg_dict,
+            sort_keys=True,
+            separators=(',', ':')
+        )).hexdigest()
+        self._set_extra(harvest_object, 'pkg_hash', pkg_hash)
+        if not self._is_incremental():
+            return False
+        return (
+            self._get_previous_extra(harvest_object, 'pkg_hash') ==
+            pkg_hash and
+            self._get_previous_package_state(harvest_object) == 'active'
+        )
+
+    def _get_previous_package_state(self, harvest_object):
+        '''
+        Returns the state of the dataset of the current harvest object with
+        the same guid, None if there is no such dataset
+        '''
+        query = model.Session.query(model.Package.state).join(
+            HarvestObject,
+            HarvestObject.package_id == model.Package.id
+        ).filter(
+            HarvestObject.guid == harvest_object.guid,
+            HarvestObject.current == True,  # noqa
+            HarvestObject.id != harvest_object.id,
+            HarvestObject.harvest_source_id ==
+            harvest_object.harvest_source_id
+        )
+        row = query.first()
+        return row[0] if row else None
+
+    def _replace_previous_object(self, harvest_object):
+        '''
+        Makes the harvest object of an unchanged study current instead of
+        the object of the last import, without updating the dataset. The
+        next import compares with the extras of this object (e.g. the
+        `changed` timestamp and the validators), those it does not have
+        (e.g. the content hash if the file was not modified) and the
+        content are taken over from the previous object.
+        '''
+        previous = model.Session.query(HarvestObject).filter(
+            HarvestObject.guid == harvest_object.guid,
+            HarvestObject.current == True,  # noqa
+            HarvestObject.id != harvest_object.id,
+            HarvestObject.harvest_source_id ==
+            harvest_object.harvest_source_id
+        ).first()
+        if previous is None:
+            return
+        keys = set(extra.key for extra in harvest_object.extras)
+        for extra in previous.extras:
+            if extra.key not in keys:
+                self._set_extra(harvest_object, extra.key, extra.value)
+        if harvest_object.content is None:
+            harvest_object.content = previous.content
+        harvest_object.package_id = previous.package_id
+        previous.current = False
+        harvest_object.current = True
+
+    def _set_extra(self, harvest_object, key, value):
+        for extra in harvest_object.extras:
+            if extra.key == key:
+                extra.value = value
+                return
+        harvest_object.extras.append(HarvestObjectExtra(key=key, value=value))
+
+    def _fetch_content(self, harvest_object, url):
+        '''
+        Fetch the DDI file of the harvest object. If the ETag or
+        Last-Modified header of the file were stored on the last import
+        (and the import is still valid), the file is only downloaded if it
+        was modified since, otherwise the content of the harvest object
+        stays empty.
+        '''
+        etag = None
+        last_modified = None
+        if self._is_incremental() and \
+                self._is_previous_import_valid(harvest_object):
+            etag = self._get_previous_extra(harvest_object, 'etag')
+            last_modified = self._get_previous_extra(
+                harvest_object,
+                'last_modified'
+            )
+        content, etag, last_modified = fetch_if_modified(
+            url,
+            etag,
+            last_modified,
+            timeout=self._get_timeout()
+        )
+        self._set_validators(harvest_object, etag, last_modified)
+        harvest_object.content = self._cache_content(content)
+
+    def _is_prefetched_unmodified(self, harvest_object):
+        '''
+        True if the gather stage sent a conditional GET for the DDI file
+        and it was not modified: the object has the validators, but no
+        content (a failed prefetch stores neither)
+        '''
+        keys = set(extra.key for extra in harvest_object.extras)
+        return 'etag' in keys or 'last_modified' in keys
+
+    def _set_validators(self, harvest_object, etag, last_modified):
+        # stored for the conditional GET of the next import
+        if etag:
+            self._set_extra(harvest_object, 'etag', etag)
+        if last_modified:
+            self._set_extra(harvest_object, 'last_modified', last_modified)
+
+    def _cache_content(self, content):
+        '''
+        Stores the content in the document cache (if configured) and returns
+        the reference that is stored in the harvest object instead
+        '''
+        cache = get_cache()
+        if cache is None or content is None:
+            return content
+        return CACHE_REFERENCE + cache.put(content.encode('utf-8'))
+
+    def _get_content(self, guid, content, base_url):
+        '''
+        Returns the DDI file of a harvest object, reading it from the
+        document cache if the object contains a reference
+        '''
+        if not content or not content.startswith(CACHE_REFERENCE):
+            return content
+        cache = get_cache()
+        if cache is not None:
+            cached = cache.get(content[len(CACHE_REFERENCE):])
+            if cached is not None:
+                return cached.decode('utf-8')
+        # removed from the cache in the meantime
+        ddi_api_url = base_url + self._get_ddi_api(guid)
+        log.debug('DDI file not cached, fetching %s' % ddi_api_url)
+        return fetch_text(ddi_api_url, timeout=self._get_timeout())
+
+    def _prefetch_contents(self, base_url, rows, validators=None):
+        '''
+        Fetch the DDI documents of all rows concurrently if the
+        `fetch_concurrency` option is set, otherwise they are fetched
+        one by one in the fetch stage. With the validators of the last
+        import (by guid), the documents are only downloaded if they were
+        modified since.
+        Returns a list with a tuple (content, etag, last_modified) for each
+        row, all None if the document was not fetched, content is None if
+        it was not modified.
+        '''
+        concurrency = self._get_fetch_concurrency()
+        if concurrency <= 1:
+            return [(None, None, None)] * len(rows)
+
+        urls = [base_url + self._get_ddi_api(row['id']) for row in rows]
+        log.debug(
+            'Fetching %s documents with %s concurrent requests'
+            % (len(urls), concurrency)
+        )
+        validators = validators or {}
+        # failed requests are retried in the fetch stage
+        return [
+            result or (None, None, None) for result, error
+            in fetch_all_if_modified(
+                urls,
+                concurrency,
+                timeout=self._get_timeout(),
+                validators=[
+                    validators.get(unicode(row['id']), (None, None))
+                    for row in rows
+                ]
+            )
+        ]
+
     def fetch_stage(self, harvest_object):
         log.debug('In NadaHarvester fetch_stage')
         self._set_config(harvest_object.job.source.config)
@@ -161,18 +685,36 @@ class NadaHarvester(HarvesterBase):
             )
             return False
 
+        if self._is_completed(harvest_object):
+            return 'unchanged'
+
         base_url = harvest_object.source.url.rstrip('/')
         ddi_api_url = None
         try:
             ddi_api_url = base_url + self._get_ddi_api(harvest_object.guid)
-            log.debug('Fetching content from %s' % ddi_api_url)
-            headers = {
-                'User-agent': 'Mozilla/5.0'
-            }
-            r = requests.get(ddi_api_url, headers=headers)
-            r.encoding = 'utf-8'
-            harvest_object.content = r.text
+            if harvest_object.content:
+                log.debug(
+                    'Content of %s already fetched in gather stage'
+                    % harvest_object.guid
+                )
+            elif self._is_prefetched_unmodified(harvest_object):
+                log.debug(
+                    'Content of %s not modified according to the gather stage'
+                    % harvest_object.guid
+                )
+            else:
+                log.debug('Fetching content from %s' % ddi_api_url)
+                self._fetch_content(harvest_object, ddi_api_url)
+            unchanged = self._content_unchanged(harvest_object)
+            if unchanged:
+                self._replace_previous_object(harvest_object)
+                NadaHarvester._replaced_object_id = harvest_object.id
             harvest_object.save()
+            if unchanged:
+                log.debug('Content of %s is unchanged' % harvest_object.guid)
+                # not imported, this may have been the last object
+                self._flush_index_if_finished(harvest_object)
+                return 'unchanged'
             log.debug('successfully processed ' + harvest_object.guid)
             return True
         except Exception, e:
@@ -183,6 +725,7 @@ class NadaHarvester(HarvesterBase):
                 ),
                 harvest_object
             )
+            self._flush_index_if_finished(harvest_object)
             return False
 
     def import_stage(self, harvest_object):
@@ -198,47 +741,47 @@ class NadaHarvester(HarvesterBase):
             return False
 
         try:
-            base_url = harvest_object.source.url.rstrip('/')
-            ckan_metadata = DdiCkanMetadata()
-            pkg_dict = ckan_metadata.load(harvest_object.content)
-            pkg_dict = self._convert_to_extras(pkg_dict)
+            # older versions of ckanext-harvest do not handle an
+            # 'unchanged' fetch stage and run the import stage right after
+            # it, the object already replaced the previous one then
+            if harvest_object.id == NadaHarvester._replaced_object_id:
+                log.debug('Skip import of unchanged %s' % harvest_object.guid)
+                return 'unchanged'
 
-            # update URL with NADA catalog link
-            catalog_path = self._get_catalog_path(harvest_object.guid)
-            pkg_dict['url'] = base_url + catalog_path
-
-            # set license from harvester config or use CKAN instance default
-            if 'license' in self.config:
-                pkg_dict['license_id'] = self.config['license']
+            base_url = harvest_object.source.url.rstrip('/')
+            license_id = self._get_license_id()
+            profile = self._get_profile(harvest_object.harvest_job_id)
+            if profile is None and self._get_parse_processes() > 1:
+                pkg_dict, variable_store = self._parse_in_pool(
+                    harvest_object,
+                    base_url,
+                    license_id
+                )
             else:
-                pkg_dict['license_id'] = config.get(
-                    'ckanext.ddi.default_license',
-                    ''
+                pkg_dict, variable_store = extract_study(
+                    *self._get_parse_args(
+                        harvest_object.guid,
+                        harvest_object.content,
+                        base_url,
+                        license_id
+                    ),
+                    profile=profile
                 )
-            tags = []
-            for tag in pkg_dict['tags']:
-                if isinstance(tag, basestring):
-                    tags.append(munge_tag(tag[:100]))
-            pkg_dict['tags'] = tags
-            pkg_dict['version'] = pkg_dict['version'][:100]
-
-            # add resources
-            resources = [
-                {
-                    'url': base_url + self._get_ddi_api(harvest_object.guid),
-                    'name': 'DDI XML of %s' % pkg_dict['title'],
-                    'format': 'xml'
-                },
-                {
-                    'url': pkg_dict['url'],
-                    'name': 'NADA catalog entry',
-                    'format': 'html'
-                },
-            ]
-            pkg_dict['resources'] = resources
+            if profile is not None:
+                self._write_profile(harvest_object.harvest_job_id, profile)
 
             log.debug('package dict: %s' % pkg_dict)
-            return self._create_or_update_package(pkg_dict, harvest_object)
+            if self._pkg_dict_unchanged(harvest_object, pkg_dict):
+                log.debug('Dataset of %s is unchanged' % harvest_object.guid)
+                self._replace_previous_object(harvest_object)
+                harvest_object.save()
+                # the content changed, its variables may have as well
+                self._save_variables(harvest_object, variable_store)
+                return 'unchanged'
+            result = self._write_package(pkg_dict, harvest_object)
+            if result is True:
+                self._save_variables(harvest_object, variable_store)
+            return result
         except Exception, e:
             self._save_object_error(
                 (
@@ -248,23 +791,343 @@ class NadaHarvester(HarvesterBase):
                 harvest_object
             )
             return False
+        finally:
+            self._flush_index_if_finished(harvest_object)
+
+    def _write_package(self, pkg_dict, harvest_object):
+        indexer = self._get_indexer(harvest_object.harvest_job_id)
+        if indexer is None:
+            return self._create_or_update_package(pkg_dict, harvest_object)
+
+        with automatic_indexing_disabled():
+            result = self._create_or_update_package(pkg_dict, harvest_object)
+        if result is True and harvest_object.package_id:
+            indexer.add(harvest_object.package_id)
+        return result
+
+    def _save_variables(self, harvest_object, variable_store):
+        '''
+        Stores the variables extracted from the DDI file for the dataset,
+        the import does not fail if this is not possible
+        '''
+        if variable_store is None or not harvest_object.package_id:
+            return
+        try:
+            variables.save_variables(
+                harvest_object.package_id,
+                variable_store
+            )
+            log.debug(
+                'Stored %s variables of %s'
+                % (len(variable_store), harvest_object.guid)
+            )
+        except Exception, e:
+            log.error(
+                'Could not store the variables of %s: %r'
+                % (harvest_object.guid, e)
+            )
+
+    def _get_indexer(self, job_id):
+        '''
+        Returns the indexer collecting the datasets of the harvest job if
+        the `defer_indexing` option is set, otherwise None
+        '''
+        if not self.config.get('defer_indexing', False):
+            return None
+
+        indexer_job_id, indexer = NadaHarvester._job_indexer
+        if indexer_job_id != job_id:
+            if indexer is not None:
+                indexer.flush()
+            indexer = DeferredIndexer(
+                batch_size=int(self.config.get('index_batch_size', 100))
+            )
+            NadaHarvester._job_indexer = (job_id, indexer)
+        return indexer
+
+    def _flush_index_if_finished(self, harvest_object):
+        '''
+        Indexes the remaining datasets of the harvest job collected by this
+        process once no other object of the job is waiting. Then this
+        process gets no more objects of the job, and the datasets are
+        indexed before the job is marked as finished.
+        '''
+        job_id, indexer = NadaHarvester._job_indexer
+        if indexer is None or job_id != harvest_object.harvest_job_id:
+            return
+        waiting = model.Session.query(HarvestObject.id).filter(
+            HarvestObject.harvest_job_id == job_id,
+            HarvestObject.state == 'WAITING',
+            HarvestObject.id != harvest_object.id
+        ).first()
+        if waiting is not None:
+            return
+        try:
+            indexer.flush()
+        except Exception:
+            log.error(
+                'Could not index the datasets of harvest job %s: %s'
+                % (job_id, traceback.format_exc())
+            )
+
+    def _get_license_id(self):
+        # license from harvester config or the CKAN instance default
+        if 'license' in self.config:
+            return self.config['license']
+        return config.get('ckanext.ddi.default_license', '')
+
+    def _get_parse_args(self, guid, content, base_url, license_id):
+        return (
+            self._get_content(guid, content, base_url),
+            base_url + self._get_ddi_api(guid),
+            base_url + self._get_catalog_path(guid),
+            license_id,
+            variables.get_variables_dir() is not None,
+        )
+
+    def _get_fetch_concurrency(self):
+        return int(self.config.get('fetch_concurrency', 1))
+
+    def _get_parse_processes(self):
+        processes = int(self.config.get('parse_processes', 0))
+        if processes > 1 and self._get_fetch_concurrency() <= 1:
+            # only documents prefetched in the gather stage can be parsed
+            # ahead, otherwise the pool parses one document at a time and
+            # only adds the cost of passing it to another process
+            if not NadaHarvester._parse_processes_warned:
+                log.warning(
+                    'parse_processes is ignored without fetch_concurrency, '
+                    'the documents are parsed in the import process'
+                )
+                NadaHarvester._parse_processes_warned = True
+            return 0
+        return processes
+
+    def _get_parse_pool(self):
+        processes = self._get_parse_processes()
+        pool_processes, pool = NadaHarvester._parse_pool
+        if pool_processes != processes:
+            self._stop_parse_pool()
+            log.debug('Starting a pool of %s parse processes' % processes)
+            pool = Pool(processes)
+            NadaHarvester._parse_pool = (processes, pool)
+            NadaHarvester._parsing = {}
+        return pool
+
+    def _parse_in_pool(self, harvest_object, base_url, license_id):
+        '''
+        Parses the content of the harvest object in the parse pool and
+        returns its dataset dict and variables (see extract_study). While
+        waiting for the result, the next fetched objects of the same job
+        are handed to the pool as well (up to `parse_queue_depth`), so
+        their results are ready when they are imported.
+        '''
+        pool = self._get_parse_pool()
+        result = NadaHarvester._parsing.pop(harvest_object.id, None)
+        if result is None:
+            result = pool.apply_async(parse_study, (self._get_parse_args(
+                harvest_object.guid,
+                harvest_object.content,
+                base_url,
+                license_id
+            ),))
+        self._parse_ahead(pool, harvest_object, base_url, license_id)
+
+        try:
+            pkg_dict, variable_store, error = result.get(float(self.config.get(
+                'parse_timeout',
+                self.DEFAULT_PARSE_TIMEOUT
+            )))
+        except TimeoutError:
+            # the worker may have been killed (e.g. out of memory), then
+            # the result never arrives
+            log.warning(
+                'No result of the parse pool for %s, parse it in this process'
+                % harvest_object.guid
+            )
+            self._stop_parse_pool()
+            return extract_study(*self._get_parse_args(
+                harvest_object.guid,
+                harvest_object.content,
+                base_url,
+                license_id
+            ))
+        if error is not None:
+            raise ParseError(error)
+        return pkg_dict, variable_store
+
+    def _stop_parse_pool(self):
+        # a new pool is started for the next object
+        pool_processes, pool = NadaHarvester._parse_pool
+        if pool is not None:
+            pool.terminate()
+        NadaHarvester._parse_pool = (None, None)
+        NadaHarvester._parsing = {}
+
+    def _parse_ahead(self, pool, harvest_object, base_url, license_id):
+        depth = int(self.config.get(
+            'parse_queue_depth',
+            2 * self._get_parse_processes()
+        ))
+        waiting_ids = [
+            obj_id for (obj_id,) in model.Session.query(HarvestObject.id)
+            .filter(
+                HarvestObject.harvest_job_id ==
+                harvest_object.harvest_job_id,
+                HarvestObject.state == 'WAITING',
+                HarvestObject.content != None  # noqa
+            )
+            .order_by(HarvestObject.gathered, HarvestObject.id)
+            .limit(depth)
+        ]
+        # results of objects that are no longer waiting (e.g. imported by
+        # another process or of an earlier job) are dropped
+        parsing = dict(
+            (obj_id, NadaHarvester._parsing[obj_id])
+            for obj_id in waiting_ids
+            if obj_id in NadaHarvester._parsing
+        )
+        new_ids = [obj_id for obj_id in waiting_ids if obj_id not in parsing]
+        if new_ids:
+            query = model.Session.query(
+                HarvestObject.id,
+                HarvestObject.guid,
+                HarvestObject.content
+            ).filter(HarvestObject.id.in_(new_ids))
+            for obj_id, guid, content in query:
+                parsing[obj_id] = pool.apply_async(parse_study, (
+                    self._get_parse_args(guid, content, base_url, license_id),
+                ))
+        NadaHarvester._parsing = parsing
+
+    def _get_profile(self, job_id):
+        '''
+        Returns the extraction profile aggregating the statistics of all
+        objects of the harvest job, None if profiling is not enabled
+        '''
+        profile_dir = config.get('ckanext.ddi.profile_dir')
+        statsd = config.get('ckanext.ddi.profile_statsd')
+        if not profile_dir and not statsd:
+            return None
+
+        profile_job_id, profile = NadaHarvester._job_profile
+        if profile_job_id != job_id:
+            sink = None
+            if statsd:
+                host, port = statsd.rsplit(':', 1)
+                sink = StatsdSink(host, port, 'ckanext.ddi.extract')
+            profile = ExtractionProfile(sink)
+            NadaHarvester._job_profile = (job_id, profile)
+        return profile
+
+    def _write_profile(self, job_id, profile):
+        profile_dir = config.get('ckanext.ddi.profile_dir')
+        if profile_dir:
+            # every import process writes its own file
+            profile.write_json(os.path.join(
+                profile_dir,
+                'extraction-%s-%s.json' % (job_id, os.getpid())
+            ))
 
     def _convert_to_extras(self, pkg_dict):
-        if 'extras' not in pkg_dict:
-            pkg_dict['extras'] = []
-        keys_to_delete = []
-        for key in pkg_dict:
-            if key not in self.DEFAULT_ATTRIBUTES:
-                log.debug('Converting %s to extra' % key)
-                pkg_dict['extras'].append((key, pkg_dict[key]))
-                keys_to_delete.append(key)
-
-        for key in keys_to_delete:
-            if key in pkg_dict:
-                log.debug('Delete key %s from pkg_dict' % key)
-                del pkg_dict[key]
-        return pkg_dict
+        return convert_to_extras(pkg_dict, self.DEFAULT_ATTRIBUTES)
+
+
+def convert_to_extras(pkg_dict, attributes):
+    if 'extras' not in pkg_dict:
+        pkg_dict['extras'] = []
+    keys_to_delete = []
+    for key in pkg_dict:
+        if key not in attributes:
+            log.debug('Converting %s to extra' % key)
+            pkg_dict['extras'].append((key, pkg_dict[key]))
+            keys_to_delete.append(key)
+
+    for key in keys_to_delete:
+        if key in pkg_dict:
+            log.debug('Delete key %s from pkg_dict' % key)
+            del pkg_dict[key]
+    return pkg_dict
+
+
+def build_pkg_dict(content, ddi_url, catalog_url, license_id, profile=None):
+    '''
+    Extracts the metadata of a NADA study and prepares the dataset dict.
+    Only plain data is passed in and returned, so this can run in a
+    process of the parse pool as well.
+    '''
+    ckan_metadata = DdiCkanMetadata()
+    # the content is stored as unicode, parse it as UTF-8
+    pkg_dict = ckan_metadata.load_file(
+        BytesIO(content.encode('utf-8')),
+        encoding='utf-8',
+        profile=profile
+    )
+    pkg_dict = convert_to_extras(pkg_dict, NadaHarvester.DEFAULT_ATTRIBUTES)
+
+    # update URL with NADA catalog link
+    pkg_dict['url'] = catalog_url
+    pkg_dict['license_id'] = license_id
+
+    tags = []
+    for tag in pkg_dict['tags']:
+        if isinstance(tag, basestring):
+            tags.append(munge_tag(tag[:100]))
+    pkg_dict['tags'] = tags
+    pkg_dict['version'] = pkg_dict['version'][:100]
+
+    # add resources
+    pkg_dict['resources'] = [
+        {
+            'url': ddi_url,
+            'name': 'DDI XML of %s' % pkg_dict['title'],
+            'format': 'xml'
+        },
+        {
+            'url': catalog_url,
+            'name': 'NADA catalog entry',
+            'format': 'html'
+        },
+    ]
+    return pkg_dict
+
+
+def extract_study(content, ddi_url, catalog_url, license_id, with_variables,
+                  profile=None):
+    '''
+    Returns the dataset dict of a NADA study and the VariableStore with the
+    variables of its DDI file, None if with_variables is False
+    '''
+    pkg_dict = build_pkg_dict(
+        content,
+        ddi_url,
+        catalog_url,
+        license_id,
+        profile=profile
+    )
+    variable_store = None
+    if with_variables:
+        variable_store = variables.extract_variables(
+            BytesIO(content.encode('utf-8')),
+            encoding='utf-8'
+        )
+    return pkg_dict, variable_store
+
+
+def parse_study(args):
+    '''
+    Task of the parse pool, returns a tuple (pkg_dict, variable_store, error)
+    '''
+    try:
+        pkg_dict, variable_store = extract_study(*args)
+        return pkg_dict, variable_store, None
+    except Exception, e:
+        return None, None, '%r / %s' % (e, traceback.format_exc())
 
 
 class AccessTypeNotAvailableError(Exception):
     pass
+
+
+class ParseError(Exception):
+    pass
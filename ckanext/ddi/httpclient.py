@@ -0,0 +1,172 @@
+"""
+HTTP client shared by all requests to remote DDI sources
+"""
+import threading
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from pylons import config
+
+import logging
+log = logging.getLogger(__name__)
+
+USER_AGENT = 'Mozilla/5.0'
+
+# defaults of ckanext.ddi.http_timeout (seconds to connect and between
+# received bytes), ckanext.ddi.http_retries and ckanext.ddi.http_backoff
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+
+# server errors that are retried
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# maximum number of kept-alive connections per host, this is also the
+# upper limit for the number of concurrent requests of fetch_all()
+POOL_SIZE = 10
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Return the process-wide session, connections to the same host are kept
+    alive and reused by all requests of this process. Failed connections
+    and server errors are retried with an exponential backoff.
+    Compressed responses (gzip, deflate) are accepted and decompressed.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                retry = Retry(
+                    total=int(config.get(
+                        'ckanext.ddi.http_retries',
+                        DEFAULT_RETRIES
+                    )),
+                    backoff_factor=float(config.get(
+                        'ckanext.ddi.http_backoff',
+                        DEFAULT_BACKOFF
+                    )),
+                    status_forcelist=RETRY_STATUSES
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=POOL_SIZE,
+                    pool_maxsize=POOL_SIZE,
+                    max_retries=retry
+                )
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers['User-agent'] = USER_AGENT
+                _session = session
+    return _session
+
+
+def get_timeout(timeout=None):
+    """ The given timeout or the configured default """
+    if timeout is None:
+        timeout = config.get('ckanext.ddi.http_timeout', DEFAULT_TIMEOUT)
+    return float(timeout)
+
+
+def fetch(url, timeout=None, headers=None):
+    """ GET the URL and return the response, raises for HTTP errors """
+    r = get_session().get(url, timeout=get_timeout(timeout), headers=headers)
+    r.raise_for_status()
+    return r
+
+
+def fetch_text(url, encoding='utf-8', timeout=None):
+    """ Fetch the URL and return the body as unicode """
+    r = fetch(url, timeout)
+    r.encoding = encoding
+    return r.text
+
+
+def fetch_if_modified(url, etag=None, last_modified=None, encoding='utf-8',
+                      timeout=None):
+    """
+    Fetch the URL with a conditional GET, using the ETag and Last-Modified
+    headers of an earlier response.
+
+    Returns a tuple (text, etag, last_modified), text is None if the server
+    answered that the document was not modified. If encoding is None, the
+    body is returned as byte string.
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    r = fetch(url, timeout, headers)
+    if r.status_code == 304:
+        return None, etag, last_modified
+    if encoding is None:
+        body = r.content
+    else:
+        r.encoding = encoding
+        body = r.text
+    return (
+        body,
+        r.headers.get('ETag'),
+        r.headers.get('Last-Modified'),
+    )
+
+
+def fetch_all(urls, concurrency, encoding='utf-8', timeout=None):
+    """
+    Fetch all URLs with at most `concurrency` requests at the same time.
+
+    Returns a list of (text, error) tuples in the order of `urls`, error
+    is None if the URL was fetched successfully.
+    """
+    return _fetch_concurrently(
+        lambda url: fetch_text(url, encoding, timeout),
+        urls,
+        concurrency
+    )
+
+
+def fetch_all_if_modified(urls, concurrency, encoding='utf-8',
+                          timeout=None, validators=None):
+    """
+    Like fetch_all, but with conditional GETs: validators is a list with
+    the (etag, last_modified) of an earlier response for each URL
+    (optional). The results are the tuples (text, etag, last_modified) of
+    fetch_if_modified, so the validators of the responses can be stored for
+    the next conditional GET.
+    """
+    validators_by_url = dict(zip(urls, validators or []))
+
+    def fetch_url(url):
+        etag, last_modified = validators_by_url.get(url, (None, None))
+        return fetch_if_modified(
+            url,
+            etag,
+            last_modified,
+            encoding=encoding,
+            timeout=timeout
+        )
+    return _fetch_concurrently(fetch_url, urls, concurrency)
+
+
+def _fetch_concurrently(fetch_func, urls, concurrency):
+    def fetch_url(url):
+        try:
+            return fetch_func(url), None
+        except requests.exceptions.RequestException, e:
+            log.debug('Could not fetch %s: %r' % (url, e))
+            return None, e
+
+    concurrency = max(1, min(concurrency, POOL_SIZE, len(urls)))
+    pool = ThreadPool(concurrency)
+    try:
+        return pool.map(fetch_url, urls)
+    finally:
+        pool.close()
+        pool.join()
@@ -1,2 +1,3 @@
 from ckanext.ddi.importer.ddiimporter import DdiImporter
 from ckanext.ddi.importer.metadata import DdiCkanMetadata
+from ckanext.ddi.importer.bulkimporter import BulkImporter
@@ -0,0 +1,140 @@
+import glob
+import itertools
+import os
+from functools import partial
+from multiprocessing import Pool
+
+from ckanext.ddi.importer import metadata, variables
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def find_files(source):
+    """
+    Returns the paths of the DDI files to import from a directory (all XML
+    files in it and its subdirectories), a glob pattern or a manifest file
+    (one path per line, relative to the manifest)
+    """
+    if os.path.isdir(source):
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(source):
+            paths.extend(
+                os.path.join(dirpath, filename) for filename in filenames
+                if filename.lower().endswith('.xml')
+            )
+        return sorted(paths)
+    if any(char in source for char in '*?['):
+        return sorted(glob.glob(source))
+    if source.lower().endswith('.xml'):
+        return [source]
+
+    base_dir = os.path.dirname(source)
+    with open(source) as manifest:
+        lines = [line.strip() for line in manifest]
+    return [
+        os.path.join(base_dir, line) for line in lines
+        if line and not line.startswith('#')
+    ]
+
+
+def parse_file(file_path, with_variables=False):
+    """
+    Extract the metadata and, if with_variables is True, the variables of a
+    DDI file. This runs in the worker processes, so only plain data is
+    returned: a tuple (file_path, pkg_dict, variable_store, error).
+    """
+    try:
+        pkg_dict = metadata.DdiCkanMetadata().load_file(file_path)
+        variable_store = None
+        if with_variables:
+            variable_store = variables.extract_variables(file_path)
+        return file_path, pkg_dict, variable_store, None
+    except Exception, e:
+        return file_path, None, None, str(e)
+
+
+class BulkImporter(object):
+    """
+    Imports many DDI files in one process. The files are parsed by a pool
+    of `workers` processes, the datasets are created or updated by the
+    given DdiImporter in this process. If `ckanext.ddi.variables_dir` is
+    set, the variables of the files are stored as well.
+
+    If a Checkpoint is given, successfully imported files are recorded in
+    it and are skipped when the import is run again.
+    """
+    def __init__(self, importer, workers=1, checkpoint=None, progress=None):
+        self.importer = importer
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.progress = progress
+        self.total = 0
+        self.skipped = 0
+        self.imported = 0
+        self.failed = []
+
+    @property
+    def processed(self):
+        return self.skipped + self.imported + len(self.failed)
+
+    def run(self, paths, params=None):
+        self.total = len(paths)
+        pending = paths
+        if self.checkpoint is not None:
+            pending = [path for path in paths if path not in self.checkpoint]
+        self.skipped = self.total - len(pending)
+
+        parse = partial(
+            parse_file,
+            with_variables=variables.get_variables_dir() is not None
+        )
+        pool = Pool(self.workers) if self.workers > 1 else None
+        try:
+            # parse the files in chunks, so the parsed but not yet
+            # imported datasets do not pile up in memory
+            chunk_size = max(self.workers, 1) * 50
+            for i in range(0, len(pending), chunk_size):
+                chunk = pending[i:i + chunk_size]
+                if pool is not None:
+                    results = pool.imap_unordered(parse, chunk)
+                else:
+                    results = itertools.imap(parse, chunk)
+                self._import_chunk(results, params)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def _import_chunk(self, results, params):
+        file_paths = []
+        pkg_dicts = []
+        variable_stores = []
+        for file_path, pkg_dict, variable_store, error in results:
+            if error is None:
+                file_paths.append(file_path)
+                pkg_dicts.append(pkg_dict)
+                variable_stores.append(variable_store)
+            else:
+                self._done(file_path, error)
+
+        # all datasets of the chunk are imported together, so the importer
+        # can look up the existing ones in one query
+        import_results = self.importer.import_pkg_dicts(pkg_dicts, params)
+        for file_path, variable_store, (name, error) in zip(
+                file_paths, variable_stores, import_results):
+            if error is None and variable_store is not None:
+                self.importer.save_variables(name, variable_store)
+            self._done(file_path, error)
+
+    def _done(self, file_path, error):
+        if error is None:
+            self.imported += 1
+            if self.checkpoint is not None:
+                self.checkpoint.add(file_path)
+        else:
+            log.debug('Import of %s failed: %s' % (file_path, error))
+            self.failed.append((file_path, error))
+
+        if self.progress is not None:
+            self.progress(self)
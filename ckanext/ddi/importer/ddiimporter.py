@@ -1,11 +1,14 @@
 import requests
-import codecs
-from pprint import pprint
+from io import BytesIO
 
 import ckan.plugins.toolkit as tk
+from ckan import model
 from ckan.lib.munge import munge_title_to_name, munge_name
 from ckanext.harvest.harvesters import HarvesterBase
-from ckanext.ddi.importer import metadata
+from ckanext.ddi.importer import metadata, variables
+from ckanext.ddi.cache import get_cache
+from ckanext.ddi.httpclient import fetch, fetch_if_modified
+from ckanext.ddi.indexing import automatic_indexing_disabled
 
 import ckanapi
 
@@ -15,28 +18,65 @@ log = logging.getLogger(__name__)
 
 
 class DdiImporter(HarvesterBase):
-    def __init__(self, username=None):
+    def __init__(self, username=None, indexer=None):
+        """
+        If a DeferredIndexer is given, the imported datasets are not indexed
+        one by one, but collected by the indexer
+        """
         self.username = username
+        self.indexer = indexer
+        self.allow_duplicates = tk.asbool(
+            config.get('ckanext.ddi.allow_duplicates', False)
+        )
+        self.override_datasets = tk.asbool(
+            config.get('ckanext.ddi.override_datasets', False)
+        )
+        self._registry = None
+        # dataset name -> True/False if it exists, see prefetch_existing
+        self._existing_names = {}
 
-    def run(self, file_path=None, url=None, params=None, upload=None):
+    @property
+    def registry(self):
+        if self._registry is None:
+            self._registry = ckanapi.LocalCKAN(username=self.username)
+        return self._registry
+
+    def run(self, file_path=None, url=None, params=None, upload=None,
+            fileobj=None, progress=None):
+        """
+        Import a DDI file from a path, a URL or a file-like object (e.g. an
+        uploaded file). Files are parsed directly, only the part of the
+        document with the study description is read.
+        If `ckanext.ddi.variables_dir` is set, the variables of the file are
+        stored as well.
+        If given, progress is called with a message at every step.
+        """
+        progress = progress or (lambda message: None)
         pkg_dict = None
-        ckan_metadata = metadata.DdiCkanMetadata()
+        variable_store = None
         if file_path is not None:
-            with codecs.open(file_path, 'r', encoding='utf-8') as xml_file:
-                pkg_dict = ckan_metadata.load(xml_file.read())
+            progress('Reading the DDI file')
+            pkg_dict, variable_store = self._load(file_path)
+        elif fileobj is not None:
+            progress('Reading the DDI file')
+            fileobj.seek(0)
+            pkg_dict, variable_store = self._load(fileobj)
+            # the upload is stored as resource from the start of the file
+            fileobj.seek(0)
         elif url is not None:
             log.debug('Fetch file from %s' % url)
+            progress('Fetching the DDI file from %s' % url)
             try:
-                r = requests.get(url)
+                document = self._fetch_document(url)
             except requests.exceptions.RequestException, e:
                 raise ContentFetchError(
                     'Error while getting URL %s: %r'
                     % (url, e)
                 )
-            r.encoding = 'utf-8'
-            xml_file = r.text
-
-            pkg_dict = ckan_metadata.load(xml_file)
+            # let lxml detect the encoding of the document
+            progress('Reading the DDI file')
+            with document:
+                pkg_dict, variable_store = self._load(document)
             resources = []
 
             # if we can assume the URL is from a NADA catalogue
@@ -62,6 +102,65 @@ class DdiImporter(HarvesterBase):
             })
             pkg_dict['resources'] = resources
 
+        progress('Saving the dataset')
+        name = self.import_pkg_dict(pkg_dict, params, upload)
+        if variable_store is not None:
+            progress('Saving the variables')
+            self.save_variables(name, variable_store)
+        return name
+
+    def _load(self, source):
+        """
+        Returns the metadata and the variables (None if variables are not
+        stored) of the DDI file
+        """
+        pkg_dict = metadata.DdiCkanMetadata().load_file(source)
+        if variables.get_variables_dir() is None:
+            return pkg_dict, None
+        if hasattr(source, 'seek'):
+            source.seek(0)
+        return pkg_dict, variables.extract_variables(source)
+
+    def save_variables(self, name, variable_store):
+        # the dataset is imported even if its variables can't be stored
+        try:
+            package = model.Package.get(name)
+            variables.save_variables(package.id, variable_store)
+            log.debug(
+                'Stored %s variables of %s' % (len(variable_store), name)
+            )
+        except Exception, e:
+            log.error('Could not store the variables of %s: %r' % (name, e))
+
+    def _fetch_document(self, url):
+        """
+        Returns the DDI file at the URL as file-like object. If the document
+        cache is configured, the file is only downloaded again if it was
+        modified since it was cached.
+        """
+        cache = get_cache()
+        if cache is None:
+            return BytesIO(fetch(url).content)
+
+        entry = cache.get_key(url) or {}
+        content, etag, last_modified = fetch_if_modified(
+            url,
+            entry.get('etag'),
+            entry.get('last_modified'),
+            encoding=None
+        )
+        if content is None:
+            document = cache.open(entry['hash'])
+            if document is not None:
+                log.debug('Using cached DDI file of %s' % url)
+                return document
+            # removed from the cache in the meantime
+            content = fetch(url).content
+        content_hash = cache.put(content)
+        cache.set_key(url, content_hash, etag, last_modified)
+        return BytesIO(content)
+
+    def import_pkg_dict(self, pkg_dict, params=None, upload=None):
         pkg_dict = self.improve_pkg_dict(pkg_dict, params)
         try:
             return self.insert_or_update_pkg(pkg_dict, upload)
@@ -71,33 +170,68 @@ class DdiImporter(HarvesterBase):
                 % (pkg_dict.get('name', ''), e)
             )
 
-    def insert_or_update_pkg(self, pkg_dict, upload=None):
-        registry = ckanapi.LocalCKAN(username=self.username)
-        allow_duplicates = tk.asbool(
-            config.get('ckanext.ddi.allow_duplicates', False)
+    def import_pkg_dicts(self, pkg_dicts, params=None):
+        """
+        Import several datasets, whether they already exist is looked up
+        for all of them with a single query.
+        Returns a list of (name, error) tuples in the order of pkg_dicts,
+        error is None if the dataset was imported successfully.
+        """
+        results = [None] * len(pkg_dicts)
+        improved = []
+        for i, pkg_dict in enumerate(pkg_dicts):
+            try:
+                improved.append((i, self.improve_pkg_dict(pkg_dict, params)))
+            except Exception, e:
+                results[i] = (pkg_dict.get('name'), self._import_error(
+                    pkg_dict,
+                    e
+                ))
+        self.prefetch_existing([pkg_dict['name'] for i, pkg_dict in improved])
+
+        for i, pkg_dict in improved:
+            try:
+                results[i] = (self.insert_or_update_pkg(pkg_dict), None)
+            except Exception, e:
+                results[i] = (pkg_dict['name'], self._import_error(
+                    pkg_dict,
+                    e
+                ))
+        return results
+
+    def _import_error(self, pkg_dict, e):
+        return 'Could not import dataset %s: %s' % (pkg_dict.get('name'), e)
+
+    def prefetch_existing(self, names):
+        """
+        Look up which of the given dataset names already exist with a single
+        query, insert_or_update_pkg then creates new datasets without
+        looking them up again
+        """
+        names = set(names)
+        query = model.Session.query(model.Package.name).filter(
+            model.Package.name.in_(names)
         )
-        override_datasets = tk.asbool(
-            config.get('ckanext.ddi.override_datasets', False)
+        existing = set(name for (name,) in query)
+        self._existing_names = dict(
+            (name, name in existing) for name in names
         )
-        try:
-            existing_pkg = registry.call_action('package_show', pkg_dict)
-            if not allow_duplicates and not override_datasets:
-                raise ContentDuplicateError(
-                    'Dataset already exists and duplicates are not allowed.'
-                )
 
-            if override_datasets:
-                pkg_dict.pop('id', None)
-                pkg_dict.pop('name', None)
-                existing_pkg.update(pkg_dict)
-                pkg_dict = existing_pkg
-                registry.call_action('package_update', pkg_dict)
-            else:
-                raise ckanapi.NotFound()
-        except ckanapi.NotFound:
+    def insert_or_update_pkg(self, pkg_dict, upload=None):
+        if self.indexer is None:
+            return self._write_pkg(pkg_dict, upload)
+        with automatic_indexing_disabled():
+            name = self._write_pkg(pkg_dict, upload)
+        self.indexer.add(name)
+        return name
+
+    def _write_pkg(self, pkg_dict, upload=None):
+        registry = self.registry
+        if self._existing_names.pop(pkg_dict['name'], None) is False:
             pkg_dict.pop('id', None)
-            pkg_dict['name'] = self._gen_new_name(pkg_dict['name'])
             registry.call_action('package_create', pkg_dict)
+        else:
+            pkg_dict = self._insert_or_update_existing(pkg_dict)
 
         if upload is not None:
             try:
@@ -116,9 +250,32 @@ class DdiImporter(HarvesterBase):
                     'Could not upload file: %s' % str(e)
                 )
 
-        pprint(pkg_dict)
+        log.debug('Imported dataset: %r' % pkg_dict)
         return pkg_dict['name']
 
+    def _insert_or_update_existing(self, pkg_dict):
+        registry = self.registry
+        try:
+            existing_pkg = registry.call_action('package_show', pkg_dict)
+            if not self.allow_duplicates and not self.override_datasets:
+                raise ContentDuplicateError(
+                    'Dataset already exists and duplicates are not allowed.'
+                )
+
+            if self.override_datasets:
+                pkg_dict.pop('id', None)
+                pkg_dict.pop('name', None)
+                existing_pkg.update(pkg_dict)
+                pkg_dict = existing_pkg
+                registry.call_action('package_update', pkg_dict)
+            else:
+                raise ckanapi.NotFound()
+        except ckanapi.NotFound:
+            pkg_dict.pop('id', None)
+            pkg_dict['name'] = self._gen_new_name(pkg_dict['name'])
+            registry.call_action('package_create', pkg_dict)
+        return pkg_dict
+
     def improve_pkg_dict(self, pkg_dict, params):
         if pkg_dict['name'] != '':
             pkg_dict['name'] = munge_name(pkg_dict['name']).replace('_', '-')
@@ -130,7 +287,7 @@ class DdiImporter(HarvesterBase):
         # override the 'id' as this never matches the CKAN internal ID
         pkg_dict['id'] = pkg_dict['name']
 
-        if params is not None and params.get(license, None) is not None:
+        if params is not None and params.get('license') is not None:
             pkg_dict['license_id'] = params['license']
         else:
             pkg_dict['license_id'] = config.get('ckanext.ddi.default_license')
@@ -1,6 +1,8 @@
 from lxml import etree
+from timeit import default_timer as timer
 import logging
 from ckan.lib.munge import munge_title_to_name
+from ckanext.ddi.importer.profiling import get_result_size
 log = logging.getLogger(__name__)
 
 namespaces = {
@@ -26,56 +28,125 @@ namespaces = {
 }
 
 
+CODEBOOK_TAG = '{%s}codeBook' % namespaces['ddi']
+CODEBOOK_PREFIX = '//ddi:codeBook/'
+
+
+def anchor_xpath(xpath):
+    """
+    Rewrite an expression starting with a descendant search for the
+    codeBook element to be relative to the codeBook element itself.
+    This avoids a scan of the whole document (including all variables)
+    for every evaluated expression.
+    """
+    if xpath.startswith(CODEBOOK_PREFIX):
+        return 'self::ddi:codeBook/' + xpath[len(CODEBOOK_PREFIX):]
+    return xpath
+
+
+_compiled_xpaths = {}
+
+
+def compile_xpath(xpath):
+    """
+    Returns the compiled and anchored expression, the same XPath object is
+    returned for all equal expressions.
+    Strings are returned without a reference to their element (no "smart
+    strings"), so the extracted values do not keep the document alive.
+    """
+    anchored_xpath = anchor_xpath(xpath)
+    if anchored_xpath not in _compiled_xpaths:
+        _compiled_xpaths.setdefault(anchored_xpath, etree.XPath(
+            anchored_xpath,
+            namespaces=namespaces,
+            smart_strings=False
+        ))
+    return _compiled_xpaths[anchored_xpath]
+
+
+class ExtractionContext(object):
+    """
+    State of the extraction of a single document: the element the mapping
+    is evaluated on, the results of the evaluated XPath expressions
+    (shared between all values using the same expression) and the number
+    of evaluations.
+    """
+    def __init__(self, xml):
+        self.xml = xml
+        self.memo = {}
+        self.xpath_count = 0
+
+
 class Value(object):
+    """
+    A value of the mapping. Values are never modified after they are
+    created, so one mapping can be used for any number of documents and
+    threads, the document is passed to get_value in an ExtractionContext.
+    """
     def __init__(self, config, **kwargs):
         self._config = config
-        self.env = kwargs
+        self._options = kwargs
+        self._separator = kwargs.get('separator', ' ')
+
+    @property
+    def options(self):
+        return dict(self._options)
 
-    def get_value(self, **kwargs):
+    def get_value(self, context):
         """ Abstract method to return the value of the attribute """
         raise NotImplementedError
 
 
 class StringValue(Value):
-    def get_value(self, **kwargs):
+    def get_value(self, context):
         return self._config
 
 
 class XmlValue(Value):
-    def get_value(self, **kwargs):
-        self.env.update(kwargs)
-        xml = self.env['xml']
-        return etree.tostring(xml)
+    def get_value(self, context):
+        return etree.tostring(context.xml)
 
 
 class XPathValue(Value):
-    def get_element(self, xml, xpath):
-        return xml.xpath(xpath, namespaces=namespaces)[0]
+    def __init__(self, config, **kwargs):
+        super(XPathValue, self).__init__(config, **kwargs)
+        # the compiled expression is shared by all values with the same
+        # expression and reused for every document
+        self._xpath = compile_xpath(config)
 
-    def get_value(self, **kwargs):
-        self.env.update(kwargs)
-        xml = self.env['xml']
+    def get_element(self, results):
+        return results[0]
 
-        xpath = self._config
-        log.debug("XPath: %s" % (xpath))
+    def evaluate(self, context):
+        """
+        Evaluate the expression on the document of the context, every
+        expression is evaluated only once per document
+        """
+        if self._xpath not in context.memo:
+            context.xpath_count += 1
+            context.memo[self._xpath] = self._xpath(context.xml)
+        return context.memo[self._xpath]
+
+    def get_value(self, context):
+        log.debug("XPath: %s", self._config)
 
         try:
             # this should probably return a XPathTextValue
-            value = self.get_element(xml, xpath)
+            value = self.get_element(self.evaluate(context))
         except Exception:
-            log.debug('XPath not found: %s' % xpath)
+            log.debug('XPath not found: %s', self._config)
             value = ''
         return value
 
 
 class XPathMultiValue(XPathValue):
-    def get_element(self, xml, xpath):
-        return xml.xpath(xpath, namespaces=namespaces)
+    def get_element(self, results):
+        return results
 
 
 class XPathTextValue(XPathValue):
-    def get_value(self, **kwargs):
-        value = super(XPathTextValue, self).get_value(**kwargs)
+    def get_value(self, context):
+        value = super(XPathTextValue, self).get_value(context)
         if (hasattr(value, 'text') and
                 value.text is not None and
                 value.text.strip() != ''):
@@ -87,9 +158,8 @@ class XPathTextValue(XPathValue):
 
 
 class XPathMultiTextValue(XPathMultiValue):
-    def get_value(self, **kwargs):
-        self.env.update(kwargs)
-        values = super(XPathMultiTextValue, self).get_value(**kwargs)
+    def get_value(self, context):
+        values = super(XPathMultiTextValue, self).get_value(context)
         return_values = []
         for value in values:
             if (hasattr(value, 'text') and
@@ -102,25 +172,23 @@ class XPathMultiTextValue(XPathMultiValue):
 
 
 class CombinedValue(Value):
-    def get_value(self, **kwargs):
-        self.env.update(kwargs)
+    def get_value(self, context):
         value = ''
-        separator = self.env['separator'] if 'separator' in self.env else ' '
+        separator = self._separator
         for attribute in self._config:
-            new_value = attribute.get_value(**kwargs)
+            new_value = attribute.get_value(context)
             if new_value is not None:
-                value = value + attribute.get_value(**kwargs) + separator
+                value = value + new_value + separator
         return value.strip(separator)
 
 
 class DateCollectionValue(Value):
-    def get_value(self, **kwargs):
-        self.env.update(kwargs)
-        separator = self.env['separator'] if 'separator' in self.env else ' '
+    def get_value(self, context):
+        separator = self._separator
 
-        start_dates = self._config[0].get_value(**kwargs)
-        end_dates = self._config[1].get_value(**kwargs)
-        cycles = self._config[2].get_value(**kwargs)
+        start_dates = self._config[0].get_value(context)
+        end_dates = self._config[1].get_value(context)
+        cycles = self._config[2].get_value(context)
 
         value = ''
         for i, date in enumerate(start_dates):
@@ -135,12 +203,11 @@ class DateCollectionValue(Value):
 
 
 class MultiValue(Value):
-    def get_value(self, **kwargs):
-        self.env.update(kwargs)
+    def get_value(self, context):
         value = ''
-        separator = self.env['separator'] if 'separator' in self.env else ' '
+        separator = self._separator
         for attribute in self._config:
-            new_value = attribute.get_value(**kwargs)
+            new_value = attribute.get_value(context)
             try:
                 iterator = iter(new_value)
                 for inner_attribute in iterator:
@@ -157,11 +224,10 @@ class MultiValue(Value):
 
 
 class ArrayValue(Value):
-    def get_value(self, **kwargs):
-        self.env.update(kwargs)
+    def get_value(self, context):
         value = []
         for attribute in self._config:
-            new_value = attribute.get_value(**kwargs)
+            new_value = attribute.get_value(context)
             try:
                 iterator = iter(new_value)
                 for inner_attribute in iterator:
@@ -177,16 +243,14 @@ class ArrayValue(Value):
 
 
 class ArrayTextValue(Value):
-    def get_value(self, **kwargs):
-        self.env.update(kwargs)
-        values = self._config.get_value(**kwargs)
-        separator = self.env['separator'] if 'separator' in self.env else ' '
-        return separator.join(values)
+    def get_value(self, context):
+        values = self._config.get_value(context)
+        return self._separator.join(values)
 
 
 class ArrayDictNameValue(ArrayValue):
-    def get_value(self, **kwargs):
-        value = super(ArrayDictNameValue, self).get_value(**kwargs)
+    def get_value(self, context):
+        value = super(ArrayDictNameValue, self).get_value(context)
         return self.wrap_in_name_dict(value)
 
     def wrap_in_name_dict(self, values):
@@ -194,16 +258,53 @@ class ArrayDictNameValue(ArrayValue):
 
 
 class FirstInOrderValue(CombinedValue):
-    def get_value(self, **kwargs):
+    def get_value(self, context):
         for attribute in self._config:
-            value = attribute.get_value(**kwargs)
+            value = attribute.get_value(context)
             if value != '':
                 return value
         return ''
 
 
+def compile_mapping(mapping):
+    """
+    Returns a copy of the mapping with all structurally equal values (same
+    class, same configuration and options) replaced by a single shared
+    instance, which turns the value trees of the mapping into one DAG.
+    """
+    interned = {}
+
+    def intern(config):
+        if isinstance(config, Value):
+            value = type(config)(intern(config._config), **config.options)
+            key = (
+                type(value),
+                freeze(value._config),
+                tuple(sorted(value.options.items())),
+            )
+            return interned.setdefault(key, value)
+        if isinstance(config, list):
+            return [intern(item) for item in config]
+        return config
+
+    def freeze(config):
+        # interned values are unique, so they are identified by their id
+        if isinstance(config, Value):
+            return id(config)
+        if isinstance(config, list):
+            return tuple(freeze(item) for item in config)
+        return config
+
+    return dict((key, intern(value)) for key, value in mapping.items())
+
+
 class CkanMetadata(object):
     """ Provides general access to metadata for CKAN """
+
+    # tag of the element after which load_file() stops reading,
+    # None to always parse the whole document
+    stream_end_tag = None
+
     def __init__(self):
         self.metadata = dict.fromkeys([
             'id',
@@ -254,25 +355,108 @@ class CkanMetadata(object):
         """
         raise NotImplementedError
 
-    def load(self, xml_string):
+    def get_context_element(self, dataset_xml):
+        """
+            Return the element the mapping is evaluated on,
+            defaults to the root element of the document
+        """
+        return dataset_xml
+
+    def load(self, xml_string, profile=None):
+        parser = None
+        if isinstance(xml_string, unicode):
+            # lxml does not accept unicode strings with an encoding
+            # declaration, parse them as UTF-8 regardless of the declaration
+            xml_string = xml_string.encode('utf-8')
+            parser = etree.XMLParser(encoding='utf-8')
         try:
-            dataset_xml = etree.fromstring(xml_string)
+            dataset_xml = etree.fromstring(xml_string, parser)
         except etree.XMLSyntaxError, e:
             raise MetadataFormatError('Could not parse XML: %r' % e)
+        return self._extract(dataset_xml, profile)
 
+    def load_file(self, source, encoding=None, profile=None):
+        """
+            Load the metadata from a file name or a file-like object.
+
+            The document is parsed incrementally and reading stops as soon
+            as the element `stream_end_tag` is closed, so the rest of the
+            document is never read nor kept in memory.
+            If `encoding` is given, it overrides the encoding declared in
+            the document.
+            If an ExtractionProfile is given, the extraction of every key
+            is measured and recorded in it.
+        """
+        try:
+            dataset_xml = self._parse_until(
+                source,
+                self.stream_end_tag,
+                encoding
+            )
+        except etree.XMLSyntaxError, e:
+            raise MetadataFormatError('Could not parse XML: %r' % e)
+        return self._extract(dataset_xml, profile)
+
+    def _parse_until(self, source, end_tag, encoding=None):
+        if end_tag is None:
+            parser = etree.XMLParser(encoding=encoding)
+            return etree.parse(source, parser).getroot()
+
+        context = etree.iterparse(
+            source,
+            events=('end',),
+            tag=end_tag,
+            encoding=encoding
+        )
+        for event, element in context:
+            # the partial tree contains everything up to the end tag
+            return element.getroottree().getroot()
+        # end tag not found, the whole document has been parsed
+        return context.root
+
+    def _extract(self, dataset_xml, profile=None):
+        # the context only lives during the extraction, no reference to
+        # the document is kept once the metadata is returned
+        context = ExtractionContext(self.get_context_element(dataset_xml))
         ckan_metadata = {}
         for key in self.metadata:
-            log.debug("Metadata key: %s" % key)
+            log.debug("Metadata key: %s", key)
             attribute = self.get_attribute(key)
-            ckan_metadata[key] = attribute.get_value(
-                xml=dataset_xml
-            )
+            if profile is None:
+                ckan_metadata[key] = attribute.get_value(context)
+            else:
+                ckan_metadata[key] = self._profile_value(
+                    key,
+                    attribute,
+                    context,
+                    profile
+                )
+        if profile is not None:
+            profile.add_document()
         return ckan_metadata
 
+    def _profile_value(self, key, attribute, context, profile):
+        xpath_count = context.xpath_count
+        start = timer()
+        value = attribute.get_value(context)
+        profile.record(
+            key,
+            timer() - start,
+            context.xpath_count - xpath_count,
+            get_result_size(value)
+        )
+        return value
+
 
 class DdiCkanMetadata(CkanMetadata):
     """ Provides access to the DDI metadata """
-    mapping = {
+
+    # all mapped fields are part of the study description, the following
+    # sections (e.g. all variables in dataDscr) are not needed. If a
+    # document contains several stdyDscr elements, only the first is used.
+    stream_end_tag = '{%s}stdyDscr' % namespaces['ddi']
+
+    mapping = compile_mapping({
         'id': XPathTextValue('//ddi:codeBook/ddi:stdyDscr/ddi:citation/ddi:titlStmt/ddi:IDNo'),  # noqa
         'name': XPathTextValue(
             "//ddi:codeBook/ddi:stdyDscr/ddi:citation/ddi:titlStmt/ddi:IDNo"  # noqa
@@ -431,11 +615,23 @@ class DdiCkanMetadata(CkanMetadata):
                 "//ddi:codeBook/ddi:stdyDscr/ddi:stdyInfo/ddi:subject/ddi:keyword"  # noqa
             )
         ]),
-    }
+    })
 
     def get_mapping(self):
         return self.mapping
 
+    def get_context_element(self, dataset_xml):
+        """
+            The XPath expressions of the mapping are anchored at the
+            codeBook element (see anchor_xpath), which is usually the root
+        """
+        if dataset_xml.tag == CODEBOOK_TAG:
+            return dataset_xml
+        codebook = dataset_xml.find('.//' + CODEBOOK_TAG)
+        if codebook is not None:
+            return codebook
+        return dataset_xml
+
     def get_attribute(self, ckan_attribute):
         mapping = self.get_mapping()
         if ckan_attribute in mapping:
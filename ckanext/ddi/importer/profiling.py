@@ -0,0 +1,92 @@
+import json
+import os
+import socket
+import threading
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class ExtractionProfile(object):
+    """
+    Statistics of the metadata extraction per mapping key, aggregated over
+    all documents loaded with this profile: number of extractions, total
+    wall time, number of XPath evaluations and total size of the results.
+
+    If a sink is given (e.g. a StatsdSink), every single measurement is
+    passed on to it as well.
+    """
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.documents = 0
+        self.keys = {}
+        self._lock = threading.Lock()
+
+    def add_document(self):
+        with self._lock:
+            self.documents += 1
+
+    def record(self, key, seconds, xpath_count, size):
+        with self._lock:
+            stats = self.keys.setdefault(key, {
+                'count': 0,
+                'time': 0.0,
+                'xpath': 0,
+                'size': 0,
+            })
+            stats['count'] += 1
+            stats['time'] += seconds
+            stats['xpath'] += xpath_count
+            stats['size'] += size
+        if self.sink is not None:
+            self.sink.record(key, seconds, xpath_count, size)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'documents': self.documents,
+                'keys': dict(
+                    (key, dict(stats)) for key, stats in self.keys.items()
+                ),
+            }
+
+    def write_json(self, path):
+        """ Write the statistics to a JSON file (replaced atomically) """
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'w') as json_file:
+            json.dump(self.as_dict(), json_file, indent=2, sort_keys=True)
+        os.rename(tmp_path, path)
+
+
+class StatsdSink(object):
+    """
+    Sends every measurement as statsd metrics via UDP:
+
+        <prefix>.<key>.time:<ms>|ms
+        <prefix>.<key>.xpath:<evaluations>|c
+        <prefix>.<key>.size:<size>|c
+    """
+    def __init__(self, host='127.0.0.1', port=8125, prefix='ckanext.ddi'):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def record(self, key, seconds, xpath_count, size):
+        metric = '%s.%s' % (self.prefix, key)
+        lines = [
+            '%s.time:%.3f|ms' % (metric, seconds * 1000),
+            '%s.xpath:%s|c' % (metric, xpath_count),
+            '%s.size:%s|c' % (metric, size),
+        ]
+        try:
+            self._socket.sendto('\n'.join(lines), self.address)
+        except socket.error, e:
+            log.debug('Could not send metrics to statsd: %r' % e)
+
+
+def get_result_size(value):
+    """ Length of a string or list result, 0 for anything else """
+    try:
+        return len(value)
+    except TypeError:
+        return 0
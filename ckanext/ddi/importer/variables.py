@@ -0,0 +1,398 @@
+"""
+Extraction and storage of the variables (dataDscr/var) of DDI codebooks
+"""
+import json
+import os
+import re
+import threading
+import uuid
+from array import array
+
+from lxml import etree
+from pylons import config
+
+from ckanext.ddi.importer.metadata import namespaces
+
+import logging
+log = logging.getLogger(__name__)
+
+VAR_TAG = '{%s}var' % namespaces['ddi']
+LABEL_TAG = '{%s}labl' % namespaces['ddi']
+CATEGORY_TAG = '{%s}catgry' % namespaces['ddi']
+CATEGORY_VALUE_TAG = '{%s}catValu' % namespaces['ddi']
+SUM_STAT_TAG = '{%s}sumStat' % namespaces['ddi']
+
+FIELDS = ['name', 'label', 'categories', 'stats']
+
+STORE_VERSION = 1
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+# compact JSON of the categories and statistics of a variable
+encode_json = json.JSONEncoder(separators=(',', ':')).encode
+
+
+def tokenize(text):
+    """ Returns the lowercased words of the text """
+    return [token.lower() for token in TOKEN_PATTERN.findall(text or u'')]
+
+
+def _text(value):
+    if value is None:
+        return u''
+    return unicode(value).strip()
+
+
+def _read_variable(element):
+    categories = [
+        [
+            _text(category.findtext(CATEGORY_VALUE_TAG)),
+            _text(category.findtext(LABEL_TAG)),
+        ]
+        for category in element.iterfind(CATEGORY_TAG)
+    ]
+    stats = [
+        [stat.get('type', ''), _text(stat.text)]
+        for stat in element.iterfind(SUM_STAT_TAG)
+    ]
+    return {
+        'name': _text(element.get('name')),
+        'label': _text(element.findtext(LABEL_TAG)),
+        'categories': categories,
+        'stats': stats,
+    }
+
+
+def iter_variables(source, encoding=None):
+    """
+    Yields a dict for every variable of a DDI file (a file name or a
+    file-like object) with its name, label, categories (a list of
+    [value, label]) and summary statistics (a list of [type, value]). The
+    file is parsed incrementally and every variable is released after it
+    was read, so the memory use does not grow with the number of variables.
+    """
+    context = etree.iterparse(
+        source,
+        events=('end',),
+        tag=VAR_TAG,
+        encoding=encoding,
+        huge_tree=True
+    )
+    for event, element in context:
+        yield _read_variable(element)
+        element.clear()
+        # remove the already read variables from the tree as well
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+class StringColumn(object):
+    """
+    A list of strings stored in one UTF-8 encoded buffer and an array of
+    offsets into it, instead of one Python object per string
+    """
+    def __init__(self, data='', offsets=None):
+        self.data = data
+        self.offsets = offsets if offsets is not None else array('I', [0])
+        self._parts = []
+
+    def append(self, value):
+        encoded = value.encode('utf-8')
+        self._parts.append(encoded)
+        self.offsets.append(self.offsets[-1] + len(encoded))
+
+    def _join(self):
+        if self._parts:
+            self.data += ''.join(self._parts)
+            self._parts = []
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        self._join()
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.data[start:end].decode('utf-8')
+
+    def write(self, output_file):
+        self._join()
+        self.offsets.tofile(output_file)
+        output_file.write(self.data)
+
+    @classmethod
+    def read(cls, input_file, count, size):
+        offsets = array('I')
+        offsets.fromfile(input_file, count + 1)
+        return cls(input_file.read(size), offsets)
+
+
+class DictionaryColumn(object):
+    """
+    A list of strings with many repeated values (like the categories of
+    variables, which often share the same scale): every distinct value is
+    stored once, the list itself is an array of indexes of the values
+    """
+    def __init__(self, values=None, codes=None):
+        self.values = values if values is not None else StringColumn()
+        self.codes = codes if codes is not None else array('I')
+        self._codes = {}
+
+    def append(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.values)
+            self.values.append(value)
+        self.codes.append(code)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, index):
+        return self.values[self.codes[index]]
+
+    def write(self, output_file):
+        self.codes.tofile(output_file)
+        self.values.write(output_file)
+
+    @classmethod
+    def read(cls, input_file, count, value_count, size):
+        codes = array('I')
+        codes.fromfile(input_file, count)
+        return cls(StringColumn.read(input_file, value_count, size), codes)
+
+
+class VariableStore(object):
+    """
+    Compact store of the variables of a dataset. Every field is kept in a
+    column (categories and statistics as JSON, the categories dictionary
+    encoded), the words of the names and labels in an inverted index: a
+    sorted column of words and for every word the array of the variables
+    containing it.
+    """
+    def __init__(self):
+        self.columns = {
+            'name': StringColumn(),
+            'label': StringColumn(),
+            'categories': DictionaryColumn(),
+            'stats': StringColumn(),
+        }
+        self.words = StringColumn()
+        self.posting_offsets = array('I', [0])
+        self.postings = array('I')
+        self._index = {}
+
+    def __len__(self):
+        return len(self.columns['name'])
+
+    def add(self, variable):
+        position = len(self)
+        self.columns['name'].append(variable['name'])
+        self.columns['label'].append(variable['label'])
+        self.columns['categories'].append(encode_json(variable['categories']))
+        self.columns['stats'].append(encode_json(variable['stats']))
+        words = set(tokenize(variable['name']) + tokenize(variable['label']))
+        for word in words:
+            self._index.setdefault(word, array('I')).append(position)
+
+    def finish(self):
+        """ Build the inverted index, called after the last variable """
+        for word in sorted(self._index):
+            self.words.append(word)
+            self.postings.extend(self._index[word])
+            self.posting_offsets.append(len(self.postings))
+        self._index = {}
+        # only needed while adding, the store is smaller when it is
+        # pickled (e.g. returned by a process of the parse pool)
+        self.columns['categories']._codes = {}
+        for column in self._string_columns():
+            column._join()
+
+    def get(self, position):
+        return {
+            'name': self.columns['name'][position],
+            'label': self.columns['label'][position],
+            'categories': json.loads(self.columns['categories'][position]),
+            'stats': dict(json.loads(self.columns['stats'][position])),
+        }
+
+    def _first_word(self, prefix):
+        # binary search of the first word >= prefix
+        low, high = 0, len(self.words)
+        while low < high:
+            middle = (low + high) // 2
+            if self.words[middle] < prefix:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _find(self, prefix):
+        """ Returns the set of variables with a word starting with prefix """
+        found = set()
+        position = self._first_word(prefix)
+        while position < len(self.words) and \
+                self.words[position].startswith(prefix):
+            start = self.posting_offsets[position]
+            end = self.posting_offsets[position + 1]
+            found.update(self.postings[start:end])
+            position += 1
+        return found
+
+    def search(self, query):
+        """
+        Returns the positions of the variables whose name or label contain
+        words starting with all words of the query, all for an empty query
+        """
+        words = tokenize(query)
+        if not words:
+            return range(len(self))
+        found = None
+        for word in words:
+            matches = self._find(word)
+            found = matches if found is None else found & matches
+            if not found:
+                return []
+        return sorted(found)
+
+    def _string_columns(self):
+        return [
+            self.columns['name'],
+            self.columns['label'],
+            self.columns['categories'].values,
+            self.columns['stats'],
+            self.words,
+        ]
+
+    def save(self, path):
+        """ Write the store to a file (replaced atomically) """
+        columns = self._string_columns()
+        for column in columns:
+            column._join()
+        header = {
+            'version': STORE_VERSION,
+            'count': len(self),
+            'categories': len(self.columns['categories'].values),
+            'words': len(self.words),
+            'postings': len(self.postings),
+            'sizes': [len(column.data) for column in columns],
+        }
+        tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as output_file:
+            output_file.write(json.dumps(header) + '\n')
+            for field in FIELDS:
+                self.columns[field].write(output_file)
+            self.words.write(output_file)
+            self.posting_offsets.tofile(output_file)
+            self.postings.tofile(output_file)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        store = cls()
+        with open(path, 'rb') as input_file:
+            header = json.loads(input_file.readline())
+            if header['version'] != STORE_VERSION:
+                raise VariableStoreError(
+                    'Unsupported version %s of %s' % (header['version'], path)
+                )
+            count = header['count']
+            sizes = header['sizes']
+            store.columns['name'] = StringColumn.read(
+                input_file,
+                count,
+                sizes[0]
+            )
+            store.columns['label'] = StringColumn.read(
+                input_file,
+                count,
+                sizes[1]
+            )
+            store.columns['categories'] = DictionaryColumn.read(
+                input_file,
+                count,
+                header['categories'],
+                sizes[2]
+            )
+            store.columns['stats'] = StringColumn.read(
+                input_file,
+                count,
+                sizes[3]
+            )
+            store.words = StringColumn.read(
+                input_file,
+                header['words'],
+                sizes[4]
+            )
+            store.posting_offsets = array('I')
+            store.posting_offsets.fromfile(input_file, header['words'] + 1)
+            store.postings = array('I')
+            store.postings.fromfile(input_file, header['postings'])
+        return store
+
+
+def extract_variables(source, encoding=None):
+    """ Returns a VariableStore with all variables of the DDI file """
+    store = VariableStore()
+    for variable in iter_variables(source, encoding):
+        store.add(variable)
+    store.finish()
+    return store
+
+
+def get_variables_dir():
+    """
+    The directory of the variable stores, None if variables are not
+    extracted (`ckanext.ddi.variables_dir` is not set)
+    """
+    return config.get('ckanext.ddi.variables_dir') or None
+
+
+def _get_path(package_id):
+    return os.path.join(get_variables_dir(), '%s.vars' % package_id)
+
+
+def save_variables(package_id, store):
+    variables_dir = get_variables_dir()
+    if not os.path.isdir(variables_dir):
+        try:
+            os.makedirs(variables_dir)
+        except OSError:
+            # created by another process in the meantime
+            if not os.path.isdir(variables_dir):
+                raise
+    store.save(_get_path(package_id))
+
+
+# package id -> (modification time, VariableStore) of recently used stores
+_stores = {}
+_stores_lock = threading.Lock()
+MAX_LOADED_STORES = 20
+
+
+def load_variables(package_id):
+    """
+    Returns the VariableStore of the dataset, None if there is none.
+    Recently used stores are kept in memory until their file changes.
+    """
+    if get_variables_dir() is None:
+        return None
+    path = _get_path(package_id)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+
+    with _stores_lock:
+        entry = _stores.get(package_id)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+    store = VariableStore.load(path)
+    with _stores_lock:
+        if len(_stores) >= MAX_LOADED_STORES:
+            _stores.clear()
+        _stores[package_id] = (mtime, store)
+    return store
+
+
+class VariableStoreError(Exception):
+    pass
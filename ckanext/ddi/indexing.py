@@ -0,0 +1,95 @@
+"""
+Deferred search indexing for imports of many datasets
+"""
+import atexit
+import threading
+import traceback
+import weakref
+from contextlib import contextmanager
+
+from ckan.lib import search
+from pylons import config
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def index_packages(package_ids):
+    """ Index the datasets without committing the search index """
+    search.rebuild(package_ids=package_ids, defer_commit=True)
+
+
+def commit_index():
+    search.commit()
+
+
+@contextmanager
+def automatic_indexing_disabled():
+    """
+    Datasets created or updated within this block are not indexed, they
+    must be indexed later (e.g. with a DeferredIndexer)
+    """
+    key = 'ckan.search.automatic_indexing'
+    previous = config.get(key)
+    config[key] = False
+    try:
+        yield
+    finally:
+        if previous is None:
+            config.pop(key, None)
+        else:
+            config[key] = previous
+
+
+# all indexers of the process, the remaining datasets are indexed at exit
+_indexers = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_indexers():
+    for indexer in list(_indexers):
+        try:
+            indexer.flush()
+        except Exception:
+            log.error(
+                'Deferred indexing failed: %s' % traceback.format_exc()
+            )
+
+
+class DeferredIndexer(object):
+    """
+    Collects the ids of created or updated datasets and indexes them in
+    batches of `batch_size` datasets, with one commit of the search index
+    per batch. Remaining datasets are indexed by flush(), which must be
+    called at the end of the import, and when the process exits.
+
+    The functions to index and commit can be replaced, e.g. by a stub
+    without a search server.
+    """
+    def __init__(self, batch_size=100, index=index_packages,
+                 commit=commit_index):
+        self.batch_size = batch_size
+        self.indexed = 0
+        self._index = index
+        self._commit = commit
+        self._pending = []
+        self._lock = threading.RLock()
+        _indexers.add(self)
+
+    def add(self, package_id):
+        with self._lock:
+            if package_id not in self._pending:
+                self._pending.append(package_id)
+            if len(self._pending) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            package_ids = self._pending
+            self._pending = []
+            if not package_ids:
+                return
+            log.debug('Indexing %s datasets' % len(package_ids))
+            self._index(package_ids)
+            self._commit()
+            self.indexed += len(package_ids)
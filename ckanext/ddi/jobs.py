@@ -0,0 +1,440 @@
+"""
+Background jobs for the imports of the web interface
+"""
+import cgi
+import errno
+import json
+import os
+import re
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import traceback
+import urlparse
+import uuid
+from contextlib import contextmanager
+
+import pylons
+import routes
+from ckan import model
+from ckan.lib.cli import MockTranslator
+from paste.registry import Registry
+from pylons import config
+
+from ckanext.ddi.importer import ddiimporter
+
+import logging
+log = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+# the status of a job is kept for a week
+JOB_MAX_AGE = 7 * 24 * 60 * 60
+
+# seconds between two looks for queued jobs of the local backend
+POLL_INTERVAL = 2
+
+
+class JobStore(object):
+    """
+    Status of the import jobs, stored as one JSON file per job, so it can be
+    read by all processes of the CKAN instance. Uploaded files are kept in
+    the same directory until their job has run.
+
+    The directory is the queue of the local backend as well: a job is
+    queued by an empty `<id>.queued` file, a worker claims it by renaming
+    this file to `<id>.claimed` (which succeeds for one worker only) and
+    writes its host and process id into it.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by another process in the meantime
+                if not os.path.isdir(directory):
+                    raise
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, '%s.json' % job_id)
+
+    def upload_path(self, job_id):
+        return os.path.join(self.directory, '%s.upload' % job_id)
+
+    def _marker_path(self, job_id, marker):
+        return os.path.join(self.directory, '%s.%s' % (job_id, marker))
+
+    def mark_queued(self, job_id):
+        open(self._marker_path(job_id, 'queued'), 'w').close()
+
+    def queued_ids(self):
+        """ Returns the ids of the queued jobs, oldest first """
+        queued = []
+        for filename in os.listdir(self.directory):
+            job_id, extension = os.path.splitext(filename)
+            if extension != '.queued' or not JOB_ID_PATTERN.match(job_id):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                queued.append((os.path.getmtime(path), job_id))
+            except OSError:
+                # claimed by another worker in the meantime
+                pass
+        queued.sort()
+        return [queued_id for queued_time, queued_id in queued]
+
+    def claim(self, job_id):
+        """ Returns True if the job was claimed by this process """
+        path = self._marker_path(job_id, 'claimed')
+        try:
+            os.rename(self._marker_path(job_id, 'queued'), path)
+        except OSError:
+            return False
+        with open(path, 'w') as claimed_file:
+            claimed_file.write(_get_worker_id())
+        return True
+
+    def release(self, job_id):
+        try:
+            os.remove(self._marker_path(job_id, 'claimed'))
+        except OSError:
+            pass
+
+    def check_interrupted(self, job):
+        """
+        Marks a running job as failed if the process that claimed it was
+        stopped (only detected for processes on this host)
+        """
+        if job['state'] != RUNNING:
+            return job
+        try:
+            with open(self._marker_path(job['id'], 'claimed')) as claimed:
+                host, pid = claimed.read().rsplit(':', 1)
+        except (IOError, ValueError):
+            return job
+        if host == socket.gethostname() and not _process_exists(int(pid)):
+            self.release(job['id'])
+            self.update(
+                job,
+                state=FAILED,
+                message='',
+                error='The import was interrupted'
+            )
+        return job
+
+    def create(self, **kwargs):
+        job = dict(
+            kwargs,
+            id=uuid.uuid4().hex,
+            state=QUEUED,
+            message='',
+            result=None,
+            error=None,
+            created=time.time()
+        )
+        self.save(job)
+        self.remove_old_jobs()
+        return job
+
+    def remove_old_jobs(self, max_age=JOB_MAX_AGE):
+        expired = time.time() - max_age
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            try:
+                if os.path.getmtime(path) < expired:
+                    os.remove(path)
+            except OSError:
+                # removed by another process
+                pass
+
+    def get(self, job_id):
+        """ Returns the job dict, None if there is no such job """
+        if not JOB_ID_PATTERN.match(job_id or ''):
+            return None
+        try:
+            with open(self._path(job_id)) as job_file:
+                return json.load(job_file)
+        except IOError:
+            return None
+
+    def save(self, job):
+        job['updated'] = time.time()
+        path = self._path(job['id'])
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'w') as job_file:
+            json.dump(job, job_file)
+        os.rename(tmp_path, path)
+
+    def update(self, job, **kwargs):
+        job.update(kwargs)
+        self.save(job)
+        return job
+
+
+def _get_worker_id():
+    return '%s:%s' % (socket.gethostname(), os.getpid())
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class LocalQueue(object):
+    """
+    Runs the jobs queued in the job store in `workers` background threads.
+    Every process of the CKAN instance with workers looks for queued jobs,
+    so jobs of a process that was stopped before they ran are run by
+    another (or the next) process. With no workers, the jobs are only run
+    by `paster ddi jobs-worker`.
+    """
+    def __init__(self, store, workers=0, poll_interval=POLL_INTERVAL):
+        self.store = store
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._wake_up = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def enqueue(self, job_id):
+        self.store.mark_queued(job_id)
+        self._wake_up.set()
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self.work,
+                    name='ddi-import-%s' % i
+                )
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def work(self):
+        """ Run queued jobs until the process is stopped """
+        while True:
+            self.run_queued()
+            self._wake_up.wait(self.poll_interval)
+            self._wake_up.clear()
+
+    def run_queued(self):
+        for job_id in self.store.queued_ids():
+            if not self.store.claim(job_id):
+                continue
+            try:
+                run_job(job_id)
+            except Exception:
+                log.error(
+                    'Import job %s failed: %s'
+                    % (job_id, traceback.format_exc())
+                )
+            finally:
+                self.store.release(job_id)
+
+
+class RqQueue(object):
+    """
+    Enqueues the jobs in a Redis queue, they are run by
+    `paster ddi jobs-worker`. Requires the packages redis and rq.
+    """
+    # the jobs are always run by the workers of rq
+    workers = 0
+
+    def __init__(self, redis_url, name='ckanext-ddi'):
+        try:
+            import redis
+            import rq
+        except ImportError:
+            raise JobError(
+                'The rq jobs backend requires the packages redis and rq'
+            )
+        self._rq = rq
+        self._connection = redis.StrictRedis.from_url(redis_url)
+        self._queue = rq.Queue(name, connection=self._connection)
+
+    def enqueue(self, job_id):
+        self._queue.enqueue('ckanext.ddi.jobs.run_job', job_id)
+
+    def start(self):
+        pass
+
+    def work(self):
+        self._rq.Worker([self._queue], connection=self._connection).work()
+
+
+_store = None
+_queue = None
+_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _lock:
+            if _store is None:
+                _store = JobStore(config.get(
+                    'ckanext.ddi.jobs_dir',
+                    os.path.join(tempfile.gettempdir(), 'ckanext-ddi-jobs')
+                ))
+    return _store
+
+
+def get_queue():
+    """
+    Returns the queue of the configured backend: `local` (default) or
+    `rq`. The worker threads of the local backend are started with the
+    first call.
+    """
+    global _queue
+    if _queue is None:
+        with _lock:
+            if _queue is None:
+                queue = create_queue()
+                queue.start()
+                _queue = queue
+    return _queue
+
+
+def create_queue(workers=None):
+    """
+    Returns a new queue of the configured backend, the number of worker
+    threads of the local backend defaults to `ckanext.ddi.jobs_workers`
+    (default: 0, the jobs are run by `paster ddi jobs-worker`)
+    """
+    backend = config.get('ckanext.ddi.jobs_backend', 'local')
+    if backend == 'rq':
+        return RqQueue(config['ckanext.ddi.jobs_redis_url'])
+    elif backend == 'local':
+        if workers is None:
+            workers = int(config.get('ckanext.ddi.jobs_workers', 0))
+        return LocalQueue(get_store(), workers)
+    raise JobError('Unknown jobs backend: %s' % backend)
+
+
+def enqueue_import(user, url=None, upload=None):
+    """
+    Create and enqueue a job to import a DDI file from a URL or an upload
+    (a cgi.FieldStorage), returns the job dict
+    """
+    store = get_store()
+    filename = None
+    if upload is not None:
+        filename = upload.filename
+    job = store.create(user=user, url=url, filename=filename)
+    if upload is not None:
+        # the uploaded file is removed at the end of the request,
+        # keep a copy until the job has run
+        upload.file.seek(0)
+        with open(store.upload_path(job['id']), 'wb') as upload_file:
+            shutil.copyfileobj(upload.file, upload_file)
+    get_queue().enqueue(job['id'])
+    return job
+
+
+@contextmanager
+def _translator():
+    """
+    The CKAN actions translate messages, a job running outside of a request
+    or paster command (e.g. in a thread of the local backend) gets the same
+    translator as paster commands
+    """
+    try:
+        pylons.translator._current_obj()
+        registered = True
+    except TypeError:
+        registered = False
+    if registered:
+        yield
+        return
+
+    registry = Registry()
+    registry.prepare()
+    registry.register(pylons.translator, MockTranslator())
+    try:
+        yield
+    finally:
+        registry.cleanup()
+
+
+def _set_url_config():
+    """
+    Give routes the information to build URLs (e.g. of the resources in
+    dataset dicts) as paster commands do. Its config is kept per thread
+    and not set outside of a request, e.g. in a worker thread.
+    """
+    site_url = urlparse.urlparse(config.get('ckan.site_url', 'http://0.0.0.0'))
+    url_config = routes.request_config()
+    url_config.mapper = config.get('routes.map')
+    url_config.host = site_url.netloc + site_url.path
+    url_config.protocol = site_url.scheme
+
+
+def run_job(job_id):
+    """ Run the import job, its result is recorded in the job store """
+    store = get_store()
+    job = store.get(job_id)
+    if job is None:
+        log.error('Import job %s not found' % job_id)
+        return
+
+    upload_path = store.upload_path(job_id)
+    try:
+        _set_url_config()
+        with _translator():
+            _run_import(store, job, upload_path)
+    except Exception, e:
+        log.debug('Import job %s failed: %r' % (job_id, e))
+        store.update(job, state=FAILED, message='', error=str(e))
+    finally:
+        if os.path.exists(upload_path):
+            os.remove(upload_path)
+        # the job runs outside of a request, release its database session
+        model.Session.remove()
+
+
+def _run_import(store, job, upload_path):
+    store.update(job, state=RUNNING)
+    importer = ddiimporter.DdiImporter(username=job['user'])
+
+    def progress(message):
+        store.update(job, message=message)
+
+    if job['filename'] is not None:
+        with open(upload_path, 'rb') as upload_file:
+            pkg_id = importer.run(
+                fileobj=upload_file,
+                upload=_field_storage(upload_file, job['filename']),
+                progress=progress
+            )
+    else:
+        pkg_id = importer.run(url=job['url'], progress=progress)
+    store.update(job, state=DONE, message='', result=pkg_id)
+
+
+def _field_storage(fileobj, filename):
+    """ Wrap the file like an upload, as expected by resource_create """
+    field_storage = cgi.FieldStorage(
+        environ={'REQUEST_METHOD': 'GET', 'QUERY_STRING': ''}
+    )
+    field_storage.name = 'upload'
+    field_storage.filename = filename
+    field_storage.file = fileobj
+    return field_storage
+
+
+class JobError(Exception):
+    pass
@@ -0,0 +1,60 @@
+"""
+API actions of ckanext-ddi
+"""
+import ckan.plugins.toolkit as tk
+from ckan import model
+
+from ckanext.ddi.importer import variables
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 1000
+
+
+def _get_int(data_dict, key, default, maximum=None):
+    try:
+        value = int(data_dict.get(key, default))
+    except (TypeError, ValueError):
+        raise tk.ValidationError({key: ['Not an integer']})
+    if value < 0:
+        raise tk.ValidationError({key: ['Must be a positive integer']})
+    if maximum is not None:
+        value = min(value, maximum)
+    return value
+
+
+@tk.side_effect_free
+def ddi_variable_search(context, data_dict):
+    """
+    Search the variables of a dataset imported from a DDI file.
+
+    :param id: the id or name of the dataset
+    :param q: words the name or label of the variables must start with,
+        all variables are returned if empty (optional)
+    :param limit: the maximum number of variables returned (optional,
+        default: 20, maximum: 1000)
+    :param offset: the number of variables to skip (optional)
+
+    Returns a dict with the number of matching variables (`count`) and the
+    variables (`results`) with their name, label, categories (a list of
+    [value, label]) and summary statistics (a dict type -> value).
+    """
+    package_id = tk.get_or_bust(data_dict, 'id')
+    tk.check_access('package_show', context, {'id': package_id})
+    package = model.Package.get(package_id)
+    if package is None:
+        raise tk.ObjectNotFound('Dataset not found')
+
+    limit = _get_int(data_dict, 'limit', DEFAULT_LIMIT, MAX_LIMIT)
+    offset = _get_int(data_dict, 'offset', 0)
+
+    store = variables.load_variables(package.id)
+    if store is None:
+        return {'count': 0, 'results': []}
+    positions = store.search(data_dict.get('q', ''))
+    return {
+        'count': len(positions),
+        'results': [
+            store.get(position)
+            for position in positions[offset:offset + limit]
+        ],
+    }
@@ -1,15 +1,42 @@
 # -*- coding: utf-8 -*-
 
+import os
+import threading
+
+import ckan.lib.helpers as h
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as tk
 import yaml
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 from importer import ddiimporter
+from ckanext.ddi import logic
 
 import logging
 from pylons import config
 log = logging.getLogger(__name__)
 
+# process-wide cache of the parsed DDI config: {'entry': (key, ddi_config)}
+# where key is the (path, mtime) of the YAML file it was loaded from
+_ddi_config_cache = {}
+_ddi_config_lock = threading.Lock()
+
+# schema entries of the DDI fields: {kind: (ddi_config, entries)}, see
+# get_schema_entries
+_schema_entries_cache = {}
+
+# display plan of the DDI config: {'entry': (ddi_config, plan)}, see
+# get_display_plan
+_display_plan_cache = {}
+
+# default of ckanext.ddi.markdown_cache_size (10 MB)
+DEFAULT_MARKDOWN_CACHE_SIZE = 10 * 1024 * 1024
+
+DisplaySection = namedtuple('DisplaySection', ['key', 'title', 'fields'])
+DisplayField = namedtuple(
+    'DisplayField',
+    ['key', 'label', 'kind', 'link_prefix', 'display_field', 'display_text']
+)
+
 
 def ordered_load(stream, Loader=yaml.Loader, object_pairs_hook=OrderedDict):
     class OrderedLoader(Loader):
@@ -25,28 +52,232 @@ def ordered_load(stream, Loader=yaml.Loader, object_pairs_hook=OrderedDict):
 
 
 def get_ddi_config():
-    with open(config.get('ckanext.ddi.config_file')) as config_file:
-        ddi_config = ordered_load(config_file)
-    return ddi_config
+    """
+    Return the parsed DDI config.
+
+    The YAML file is only read again if its path or modification time
+    changed since it was last loaded. The returned dict is shared between
+    all callers and must not be modified.
+    """
+    path = config.get('ckanext.ddi.config_file')
+    key = (path, os.path.getmtime(path))
+    entry = _ddi_config_cache.get('entry')
+    if entry is None or entry[0] != key:
+        with _ddi_config_lock:
+            entry = _ddi_config_cache.get('entry')
+            if entry is None or entry[0] != key:
+                log.debug('Loading DDI config from %s' % path)
+                with open(path) as config_file:
+                    entry = (key, ordered_load(config_file))
+                _ddi_config_cache['entry'] = entry
+    return entry[1]
+
+
+def clear_ddi_config_cache():
+    """
+    Drop the cached DDI config, the next call to get_ddi_config()
+    reads the YAML file again
+    """
+    with _ddi_config_lock:
+        _ddi_config_cache.clear()
+        _schema_entries_cache.clear()
+        _display_plan_cache.clear()
+
+
+def _get_schema_validators(kind):
+    if kind == 'show':
+        return [tk.get_converter('convert_from_extras'),
+                tk.get_validator('ignore_missing')]
+    return [tk.get_validator('ignore_missing'),
+            tk.get_converter('convert_to_extras')]
+
+
+def get_schema_entries(kind):
+    """
+    Return the schema entries of all fields of the DDI config, `modify`
+    for the create and update schema, `show` for the show schema.
+
+    They are only computed again if the DDI config was reloaded. Every call
+    returns new lists of validators, so they can be modified by the caller.
+    """
+    ddi_config = get_ddi_config()
+    entry = _schema_entries_cache.get(kind)
+    if entry is None or entry[0] is not ddi_config:
+        validators = _get_schema_validators(kind)
+        fields = ddi_config['fields']
+        entry = (ddi_config, [
+            (field, validators)
+            for section in fields
+            for field in fields[section]
+        ])
+        _schema_entries_cache[kind] = entry
+    return dict((field, list(validators)) for field, validators in entry[1])
+
+
+def _get_display_field(key, field_config):
+    field_type = field_config.get('type')
+    if field_type in ('url', 'email'):
+        kind = 'link'
+    elif field_type == 'markdown':
+        kind = 'markdown'
+    else:
+        kind = 'text'
+    return DisplayField(
+        key=key,
+        label=field_config.get('display'),
+        kind=kind,
+        link_prefix='mailto:' if field_type == 'email' else '',
+        display_field=field_config.get('display_field'),
+        display_text=field_config.get('display_text')
+    )
+
+
+def get_display_plan(ddi_config=None):
+    """
+    Return the sections and visible fields of the DDI config in the order
+    they are displayed on the dataset page, as a list of DisplaySection
+    with a list of DisplayField each.
+
+    The plan is only computed again if the DDI config was reloaded.
+    """
+    if ddi_config is None:
+        ddi_config = get_ddi_config()
+    entry = _display_plan_cache.get('entry')
+    if entry is None or entry[0] is not ddi_config:
+        fields = ddi_config['fields']
+        entry = (ddi_config, [
+            DisplaySection(
+                key=section,
+                title=ddi_config['sections'].get(section, ''),
+                fields=[
+                    _get_display_field(field, fields[section][field])
+                    for field in fields[section]
+                    if fields[section][field].get('visible')
+                ]
+            )
+            for section in fields
+        ])
+        _display_plan_cache['entry'] = entry
+    return entry[1]
+
+
+class RenderCache(object):
+    """
+    Thread-safe cache of rendered strings. If the total length of the
+    cached strings exceeds `max_size`, the least recently used ones are
+    removed.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Return the cached string, None if it is not cached """
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                # move to the end, the most recently used entry
+                self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_size:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_size:
+                self.size -= len(self._entries.popitem(last=False)[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+_markdown_cache = None
+_markdown_cache_lock = threading.Lock()
+
+
+def get_markdown_cache():
+    global _markdown_cache
+    if _markdown_cache is None:
+        with _markdown_cache_lock:
+            if _markdown_cache is None:
+                _markdown_cache = RenderCache(int(config.get(
+                    'ckanext.ddi.markdown_cache_size',
+                    DEFAULT_MARKDOWN_CACHE_SIZE
+                )))
+    return _markdown_cache
+
+
+def render_markdown(pkg, field):
+    """
+    Render a markdown field of the dataset as HTML. The result is cached
+    for the id, modification time and field of the dataset, so it is only
+    rendered again if the dataset changed.
+    """
+    key = (pkg.get('id'), pkg.get('metadata_modified'), field)
+    if key[0] is None or key[1] is None:
+        # e.g. a preview of an unsaved dataset
+        return h.render_markdown(pkg[field], allow_html=True)
+
+    cache = get_markdown_cache()
+    html = cache.get(key)
+    if html is None:
+        html = h.render_markdown(pkg[field], allow_html=True)
+        cache.set(key, html)
+    return html
 
 
 def get_vocabulary_values(vocabulary):
     """
     Given the name of a vocabulary, get the accepted values for it
     """
-    log.debug(vocabulary)
-    log.debug(get_ddi_config()['vocabularies'])
     values = get_ddi_config()['vocabularies'][vocabulary]
-    log.debug(values)
+    log.debug('Vocabulary %s: %r' % (vocabulary, values))
     return values
 
 
+def _get_request_memo():
+    """
+    Return a dict that lives as long as the current request, None outside
+    of a request (e.g. in paster commands)
+    """
+    try:
+        # unset attributes of the template context are empty strings
+        memo = getattr(tk.c, 'ddi_package_dicts', None)
+        if not isinstance(memo, dict):
+            memo = tk.c.ddi_package_dicts = {}
+        return memo
+    except TypeError:
+        # no request context registered for this thread
+        return None
+
+
 def get_package_dict(dataset_id):
-    if dataset_id:
-        user = tk.get_action('get_site_user')({}, {})
-        context = {'user': user['name']}
-        return tk.get_action('package_show')(context, {'id': dataset_id})
-    return None
+    """
+    Return the dict of the dataset, it is loaded at most once per request.
+    The returned dict may be shared and must not be modified.
+    """
+    if not dataset_id:
+        return None
+
+    memo = _get_request_memo()
+    if memo is not None and dataset_id in memo:
+        return memo[dataset_id]
+    user = tk.get_action('get_site_user')({}, {})
+    context = {'user': user['name']}
+    pkg_dict = tk.get_action('package_show')(context, {'id': dataset_id})
+    if memo is not None:
+        for key in (dataset_id, pkg_dict['id'], pkg_dict['name']):
+            memo[key] = pkg_dict
+    return pkg_dict
 
 
 def import_from_xml():
@@ -59,6 +290,7 @@ def import_from_xml():
 class DdiImport(plugins.SingletonPlugin):
     plugins.implements(plugins.IRoutes)
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IActions)
 
     def before_map(self, map):
         map.connect(
@@ -71,6 +303,12 @@ class DdiImport(plugins.SingletonPlugin):
             controller='ckanext.ddi.controllers:ImportFromXml',
             action='run_import'
         )
+        map.connect(
+            'ddi_import_status',
+            '/dataset/import/job/{id}',
+            controller='ckanext.ddi.controllers:ImportFromXml',
+            action='import_status'
+        )
         return map
 
     def after_map(self, map):
@@ -80,6 +318,11 @@ class DdiImport(plugins.SingletonPlugin):
         tk.add_template_directory(config, 'templates')
         tk.add_resource('fanstatic', 'ddi')
 
+    def get_actions(self):
+        return {
+            'ddi_variable_search': logic.ddi_variable_search,
+        }
+
 
 class DdiSchema(plugins.SingletonPlugin, tk.DefaultDatasetForm):
     """
@@ -107,15 +350,7 @@ class DdiSchema(plugins.SingletonPlugin, tk.DefaultDatasetForm):
 
     def _modify_package_schema(self, schema):
         # Add new fields from the config as extras
-        fields = get_ddi_config()['fields']
-
-        for section in fields:
-            for field in fields[section]:
-                    schema.update({
-                        field: [tk.get_validator('ignore_missing'),
-                                tk.get_converter('convert_to_extras')]
-                    })
-
+        schema.update(get_schema_entries('modify'))
         return schema
 
     def create_package_schema(self):
@@ -136,15 +371,7 @@ class DdiSchema(plugins.SingletonPlugin, tk.DefaultDatasetForm):
         schema['tags']['__extras'].append(tk.get_converter('free_tags_only'))
 
         # Add new fields from the config to the dataset schema.
-        fields = get_ddi_config()['fields']
-
-        for section in fields:
-            for field in fields[section]:
-                schema.update({
-                    field: [tk.get_converter('convert_from_extras'),
-                            tk.get_validator('ignore_missing')]
-                })
-
+        schema.update(get_schema_entries('show'))
         return schema
 
 
@@ -169,6 +396,8 @@ class DdiTheme(plugins.SingletonPlugin, tk.DefaultDatasetForm):
         return {
             'ddi_theme_get_ddi_config': get_ddi_config,
             'ddi_theme_get_vocabulary_values': get_vocabulary_values,
+            'ddi_theme_get_display_plan': get_display_plan,
+            'ddi_theme_render_markdown': render_markdown,
             'ddi_theme_get_package_dict': get_package_dict,
             'ddi_theme_import_from_xml': import_from_xml
         }
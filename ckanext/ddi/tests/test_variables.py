@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the storage and search of the variables of DDI codebooks
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+
+from ckanext.ddi.importer.variables import VariableStore, extract_variables
+
+# non-ASCII labels and categories shared by several variables
+VARIABLES = [
+    {
+        'name': u'v1',
+        'label': u'Älder der Person',
+        'categories': [],
+        'stats': [[u'mean', u'41.5'], [u'max', u'99']],
+    },
+    {
+        'name': u'v2',
+        'label': u'Größe der Wohnung (m²)',
+        'categories': [[u'1', u'Männlich'], [u'2', u'Weiblich']],
+        'stats': [],
+    },
+    {
+        'name': u'v3',
+        'label': u'',
+        'categories': [[u'1', u'Männlich'], [u'2', u'Weiblich']],
+        'stats': [[u'vald', u'10']],
+    },
+]
+
+# query -> positions of the matching variables
+QUERIES = [
+    (u'', [0, 1, 2]),
+    (u'v', [0, 1, 2]),
+    (u'V2', [1]),
+    (u'älder', [0]),
+    (u'GRÖ', [1]),
+    (u'der v1', [0]),
+    (u'der v3', []),
+    (u'none', []),
+]
+
+CODEBOOK = u'''<?xml version="1.0" encoding="UTF-8"?>
+<codeBook xmlns="http://www.icpsr.umich.edu/DDI" version="1.2.2">
+<dataDscr>
+<var name="v1"><labl>Älder der Person</labl>
+<sumStat type="mean">41.5</sumStat><sumStat type="max">99</sumStat></var>
+<var name="v2"><labl>Größe der Wohnung (m²)</labl>
+<catgry><catValu>1</catValu><labl>Männlich</labl></catgry>
+<catgry><catValu>2</catValu><labl>Weiblich</labl></catgry></var>
+<var name="v3">
+<catgry><catValu>1</catValu><labl>Männlich</labl></catgry>
+<catgry><catValu>2</catValu><labl>Weiblich</labl></catgry>
+<sumStat type="vald">10</sumStat></var>
+</dataDscr>
+</codeBook>
+'''.encode('utf-8')
+
+
+def create_store(variables):
+    store = VariableStore()
+    for variable in variables:
+        store.add(variable)
+    store.finish()
+    return store
+
+
+class TestVariableStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'test.vars')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def save_and_load(self, store):
+        store.save(self.path)
+        return VariableStore.load(self.path)
+
+    def assert_variables(self, store, variables):
+        self.assertEqual(len(store), len(variables))
+        for position, variable in enumerate(variables):
+            expected = dict(variable, stats=dict(variable['stats']))
+            self.assertEqual(store.get(position), expected)
+
+    def assert_queries(self, store, queries):
+        for query, positions in queries:
+            self.assertEqual(list(store.search(query)), positions, query)
+
+    def test_get_and_search(self):
+        store = create_store(VARIABLES)
+        self.assert_variables(store, VARIABLES)
+        self.assert_queries(store, QUERIES)
+
+    def test_save_and_load(self):
+        store = self.save_and_load(create_store(VARIABLES))
+        self.assert_variables(store, VARIABLES)
+        self.assert_queries(store, QUERIES)
+
+    def test_save_and_load_empty_store(self):
+        store = self.save_and_load(create_store([]))
+        self.assert_variables(store, [])
+        self.assert_queries(
+            store,
+            [(query, []) for query, positions in QUERIES]
+        )
+
+    def test_extract_variables(self):
+        store = self.save_and_load(extract_variables(BytesIO(CODEBOOK)))
+        self.assert_variables(store, VARIABLES)
+        self.assert_queries(store, QUERIES)